@@ -2,15 +2,51 @@
 from flask import Flask
 from endpoints.custom_messaging import custom_messaging
 from endpoints.ai_messaging import ai_messaging
+from endpoints.queue_status import queue_status
+from endpoints.health import health
+from endpoints.chats import chats
+from endpoints.metrics import metrics
+from utils.prompt_templates import prompt_templates
+from utils.mongodb_connector import mongodb_connector
+from utils.skype_messaging import init_messaging
+from utils.logging_setup import setup_logging
+from utils.metrics import registry
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('FlaskApp')
 
-app = Flask(__name__)
-app.register_blueprint(custom_messaging)
-app.register_blueprint(ai_messaging)
+
+def init_worker():
+    """Per-process start-up: the log writer, the metrics flush, the MongoDB client, sender workers and Skype session refreshers.
+
+    Nothing here runs at import, so the app can be preloaded and forked. Under
+    gunicorn this runs right after each worker is forked (see gunicorn.conf.py);
+    otherwise it runs on the first request. Repeated calls are cheap no-ops.
+    """
+    setup_logging()
+    registry.start_flusher()
+    mongodb_connector.ensure_connected()
+    init_messaging()
+
+
+def create_app():
+    # Starts no threads (not even the log writer's), so gunicorn can preload it in the master and fork
+    app = Flask(__name__)
+    app.register_blueprint(custom_messaging)
+    app.register_blueprint(ai_messaging)
+    app.register_blueprint(queue_status)
+    app.register_blueprint(health)
+    app.register_blueprint(chats)
+    app.register_blueprint(metrics)
+    app.before_request(init_worker)
+    prompt_templates.install_sighup_handler()
+    return app
+
+
+# Kept for deployments started with `gunicorn app:app`; wsgi.py serves the same instance
+app = create_app()
 
 
 if __name__ == '__main__':
+    setup_logging()
     app.run(debug=True)
@@ -0,0 +1,40 @@
+# asgi.py
+# ASGI entry point: hypercorn --bind 0.0.0.0:5000 --workers 2 asgi:app
+#
+# The endpoints where requests spend their time waiting (/send-ai-message,
+# /send-custom-message, /ai-jobs/<id>) are served by the Quart app in
+# endpoints/async_messaging.py; every other route falls through to the
+# regular Flask app, run in threads.
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart
+from werkzeug.exceptions import HTTPException
+from app import app as wsgi_app, init_worker
+from endpoints.async_messaging import async_messaging, run_blocking
+import logging
+
+logger = logging.getLogger('ASGIApp')
+
+async_app = Quart(__name__)
+async_app.register_blueprint(async_messaging)
+flask_app = WsgiToAsgi(wsgi_app)
+
+
+@async_app.before_serving
+async def start_worker():
+    await run_blocking(init_worker)
+
+
+def is_async_route(scope):
+    try:
+        async_app.url_map.bind('localhost').match(scope['path'], method=scope['method'])
+        return True
+    except HTTPException:
+        return False
+
+
+async def app(scope, receive, send):
+    # Lifespan events go to Quart, which runs start_worker in each worker process
+    if scope['type'] != 'http' or is_async_route(scope):
+        await async_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
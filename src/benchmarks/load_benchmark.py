@@ -0,0 +1,256 @@
+# load_benchmark.py
+"""Offline load test of the messaging endpoints against utils.fake_skype.
+
+Runs the Flask app in-process with every Skype account replaced by FakeSkype,
+SQLite files in a temporary directory and MongoDB disabled (or, with
+--fake-mongodb, backed by utils.fake_mongodb), so nothing leaves the machine. Each scenario fires --requests requests from --concurrency
+threads and reports throughput and p50/p95/p99 latency:
+
+    api_key       GET /queue-stats (require_api_key plus a trivial handler)
+    custom_send   POST /send-custom-message, sent synchronously
+    custom_queue  POST /send-custom-message with "queue": true, then waits for the queue to drain
+    ai_message    POST /send-ai-message, waiting for the fake bot's reply
+    parser        try_parse_message over the parser benchmark corpus
+
+Run from src/:
+    python -m benchmarks.load_benchmark
+    python -m benchmarks.load_benchmark --send-latency 0.2 --reply-delay 2 --output load.json
+    python -m benchmarks.load_benchmark --baseline load.json
+
+With --baseline, scenarios whose throughput dropped or whose p95 latency rose
+by more than --tolerance are reported and the exit code is 1.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ('api_key', 'custom_send', 'custom_queue', 'ai_message', 'parser')
+GROUP_ID = '19:benchmark@thread.skype'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    ok = sum(count for status, count in statuses.items() if 200 <= status < 300)
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - ok,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def drive(call, requests, concurrency):
+    """Run call(i) for every i from concurrency threads; call returns a status code."""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            status = call(i)
+        except Exception:
+            status = 599
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+def configure_environment(args, tmp_dir):
+    """Settings that keep the app offline; must run before any app module is imported."""
+    os.environ.update({
+        'SQLITE_DB_DIR': os.path.join(tmp_dir, 'db'),
+        'SKYPE_SESSION_DIR': tmp_dir,
+        'SKYPE_USERNAME': 'benchmark.user',
+        'SKYPE_PASSWORD': 'benchmark',
+        'GROUP_ID': GROUP_ID,
+        'ENABLE_MONGODB': 'true' if args.fake_mongodb else 'false',
+        'MONGODB_DB_NAME': 'benchmark',
+        'AI_REPLY_TIMEOUT': str(args.reply_timeout),
+    })
+    os.environ.pop('SKYPE_ACCOUNTS', None)
+    # The send rate limit would otherwise dominate every number; override from the environment to measure it
+    os.environ.setdefault('MESSAGE_QUEUE_BACKEND', 'memory')
+    os.environ.setdefault('SEND_RATE_LIMIT', '6000000')
+    os.environ.setdefault('SEND_BURST_LIMIT', '1000')
+
+
+def configure_fake(args):
+    from utils.fake_skype import FakeSkype, FakeChat
+    FakeSkype.latency = args.send_latency
+    FakeSkype.failure_rate = args.failure_rate
+    FakeSkype.rate_limit = args.rate_limit
+    FakeSkype.reply_delay = args.reply_delay
+    # Enough history per getMsgs() that replies are not pushed out of the dispatcher's window
+    FakeChat.page_size = max(FakeChat.page_size, args.concurrency * 4)
+
+    from utils.skype_messaging import skype_pool
+    for session in skype_pool.sessions:
+        session.skype_factory = FakeSkype
+
+    if args.fake_mongodb:
+        from utils.fake_mongodb import FakeMongoClient
+        from utils.mongodb_connector import mongodb_connector
+        mongodb_connector.client_factory = FakeMongoClient
+    return skype_pool
+
+
+def run(args, scenarios):
+    from app import create_app
+    from utils.api_key_manager import init_db, add_api_key
+    from utils.skype_messaging import init_messaging
+    from utils.reply_parser import try_parse_message
+    from benchmarks.parser_benchmark import CORPUS
+
+    skype_pool = configure_fake(args)
+    app = create_app()
+    init_db()
+    api_key = add_api_key()
+    headers = {'x-api-key': api_key}
+    clients = threading.local()
+
+    def client():
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        return clients.client
+
+    def api_key_call(i):
+        return client().get('/queue-stats', headers=headers).status_code
+
+    def custom_send_call(i):
+        body = {"group_id": f"19:group-{i % args.groups}@thread.skype", "message": f"Benchmark message {i}"}
+        return client().post('/send-custom-message', json=body, headers=headers).status_code
+
+    def custom_queue_call(i):
+        body = {"group_id": f"19:group-{i % args.groups}@thread.skype", "message": f"Queued message {i}", "queue": True}
+        return client().post('/send-custom-message', json=body, headers=headers).status_code
+
+    def ai_message_call(i):
+        body = {"message": f"Benchmark question {i}", "session_id": f"session-{i % args.groups}"}
+        return client().post('/send-ai-message', json=body, headers=headers).status_code
+
+    def parser_call(i):
+        shape, content, expected = CORPUS[i % len(CORPUS)]
+        parsed = try_parse_message(content)
+        return 200 if (parsed.get('reply_id') if isinstance(parsed, dict) else None) == expected else 500
+
+    calls = {'api_key': api_key_call, 'custom_send': custom_send_call, 'custom_queue': custom_queue_call,
+             'ai_message': ai_message_call, 'parser': parser_call}
+
+    # Warm up the login, chat cache and API key cache outside the timings
+    client().get('/queue-stats', headers=headers)
+    init_messaging()
+
+    results = {}
+    for scenario in scenarios:
+        requests = args.parser_requests if scenario == 'parser' else args.requests
+        result = drive(calls[scenario], requests, args.concurrency)
+        if scenario == 'custom_queue':
+            result["drain_seconds"] = wait_for_drain(init_messaging(), args.drain_timeout)
+        results[scenario] = result
+        print(format_result(scenario, result))
+
+    fakes = [session.get_instance() for session in skype_pool.sessions]
+    print(f"fake skype: {sum(fake.calls for fake in fakes)} calls, {sum(len(fake.sent) for fake in fakes)} sent, "
+          f"{sum(fake.rate_limited for fake in fakes)} rate limited")
+    return results
+
+
+def wait_for_drain(scheduler, timeout):
+    """Seconds until every queued message was sent, or None if the queue did not drain in time."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if not any(stats["queued"] for stats in scheduler.stats().values()):
+            return round(time.perf_counter() - start, 3)
+        time.sleep(0.05)
+    return None
+
+
+def format_result(scenario, result):
+    line = (f"{scenario:13} {result['throughput']:9.1f} req/s  p50 {result['p50_ms']:9.2f} ms  "
+            f"p95 {result['p95_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  errors {result['errors']}")
+    if "drain_seconds" in result:
+        line += f"  drained in {result['drain_seconds']} s"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test against a fake Skype backend')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help='Comma separated subset of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint scenario')
+    parser.add_argument('--parser-requests', type=int, default=20000, help='Parses in the parser scenario')
+    parser.add_argument('--concurrency', type=int, default=20, help='Concurrent client threads')
+    parser.add_argument('--groups', type=int, default=10, help='Distinct group ids (and AI session ids) to spread requests over')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='Seconds every fake Skype call takes')
+    parser.add_argument('--reply-delay', type=float, default=0.5, help='Seconds until the fake bot answers a prompt')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of fake Skype calls that fail')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Fake Skype calls per second before calls are throttled (0 = unlimited)')
+    parser.add_argument('--fake-mongodb', action='store_true', help='Enable MongoDB logging against an in-memory mongomock client')
+    parser.add_argument('--reply-timeout', type=int, default=30, help='AI_REPLY_TIMEOUT for the ai_message scenario')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='Seconds to wait for the custom_queue scenario to drain')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous --output file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed throughput drop or p95 rise against the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix='skype-load-') as tmp_dir:
+        configure_environment(args, tmp_dir)
+        # Per-request and simulated-failure logging would swamp the output and the timings
+        logging.disable(logging.ERROR)
+        results = run(args, scenarios)
+
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+        with open(args.output, 'w') as file:
+            json.dump({"benchmark": "load", "created_at": int(time.time()), "config": config, "results": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = []
+        for scenario, result in results.items():
+            previous = baseline.get(scenario)
+            if previous is None:
+                continue
+            if result["throughput"] < previous["throughput"] * (1 - args.tolerance):
+                regressions.append(f"{scenario} throughput: {previous['throughput']} -> {result['throughput']} req/s")
+            if result["p95_ms"] > previous["p95_ms"] * (1 + args.tolerance):
+                regressions.append(f"{scenario} p95: {previous['p95_ms']} -> {result['p95_ms']} ms")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
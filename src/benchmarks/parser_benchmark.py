@@ -0,0 +1,91 @@
+# parser_benchmark.py
+"""Micro-benchmark for utils.reply_parser.try_parse_message.
+
+Run from src/:
+    python -m benchmarks.parser_benchmark
+    python -m benchmarks.parser_benchmark --output parser.json
+    python -m benchmarks.parser_benchmark --baseline parser.json
+
+With --baseline, shapes that got slower than --tolerance are reported and the
+exit code is 1, so the benchmark can gate a release.
+"""
+import argparse
+import html
+import json
+import sys
+import time
+import logging
+from utils.reply_parser import try_parse_message
+
+REPLY_ID = "3f2b8c1e-9a4d-4e7b-8f21-0c6d5e4a7b90"
+OTHER_ID = "a1b2c3d4-0000-4000-8000-000000000000"
+REPLY = {"message": "Szia! A fékbetét csere ára kb. 25 000 Ft.", "message_type": "general",
+         "session_id": "session-42", "reply_id": REPLY_ID}
+REPLY_JSON = json.dumps(REPLY, ensure_ascii=False)
+PROMPT = ("Process the given 'message' per 'instructions' and reply with 'message', 'message_type', "
+          "'session_id' and 'reply_id', in that order.\nYou are a car service expert bot.\n"
+          f"id: {OTHER_ID}\nsession_id: session-42\nmessage: Mennyibe kerül a fékbetét csere?")
+
+# (shape, content, reply_id the parse must yield or None); parsed the way the reply dispatcher does,
+# so a reply meant for another request is fully parsed too
+CORPUS = [
+    ("plain_json", REPLY_JSON, REPLY_ID),
+    ("escaped_text", html.escape(REPLY_JSON), REPLY_ID),
+    ("code_block", f'<p>Here you go:</p><pre><code class="language-json">{html.escape(json.dumps(REPLY, indent=2))}\n</code></pre>', REPLY_ID),
+    ("uriobject_xml", f'<URIObject type="RichText" uri="https://api.asm.skype.com/v1/objects/0-weu">{html.escape(REPLY_JSON)}<Title>Reply</Title></URIObject>', REPLY_ID),
+    ("multi_root_xml", f'<b>{html.escape(REPLY_JSON[:40])}</b><i>{html.escape(REPLY_JSON[40:])}</i>', REPLY_ID),
+    ("other_reply_id", REPLY_JSON.replace(REPLY_ID, OTHER_ID), OTHER_ID),
+    ("outgoing_prompt", PROMPT, None),
+    ("chatter", "Thanks, see you tomorrow at the workshop!", None),
+    ("emoticon_xml", '<ss type="smile">:)</ss> ok <a href="https://example.com">link</a>', None),
+    ("broken_json", '{"message": "cut off", "reply_id": "' + REPLY_ID, None),
+]
+
+
+def run(iterations):
+    results = {}
+    for shape, content, expected in CORPUS:
+        parsed = try_parse_message(content)
+        reply_id = parsed.get("reply_id") if isinstance(parsed, dict) else None
+        if reply_id != expected:
+            raise AssertionError(f"{shape}: expected reply_id {expected!r}, got {parsed!r}")
+        start = time.perf_counter()
+        for _ in range(iterations):
+            try_parse_message(content)
+        elapsed = time.perf_counter() - start
+        results[shape] = {"us_per_op": round(elapsed / iterations * 1e6, 3), "ops_per_sec": round(iterations / elapsed)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reply parser micro-benchmark')
+    parser.add_argument('--iterations', type=int, default=20000, help='Parses per corpus entry')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous --output file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    # Broken inputs log parse errors; keep them out of the timings
+    logging.getLogger('ReplyParser').setLevel(logging.CRITICAL)
+
+    results = run(args.iterations)
+    for shape, result in results.items():
+        print(f"{shape:16} {result['us_per_op']:10.3f} us/op {result['ops_per_sec']:>10} ops/s")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"benchmark": "reply_parser", "iterations": args.iterations, "results": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = [shape for shape, result in results.items()
+                       if shape in baseline and result["us_per_op"] > baseline[shape]["us_per_op"] * (1 + args.tolerance)]
+        for shape in regressions:
+            print(f"REGRESSION {shape}: {baseline[shape]['us_per_op']} -> {results[shape]['us_per_op']} us/op")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
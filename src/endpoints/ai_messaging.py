@@ -1,10 +1,20 @@
 # ai_messaging.py
 import os
 import uuid
-from flask import Blueprint, request, jsonify
-from utils.skype_messaging import enqueue_message, fetch_skype_reply
+import json
+import socket
+import ipaddress
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from utils.skype_messaging import enqueue_message, expect_skype_reply, fetch_skype_reply
 from utils.api_key_manager import require_api_key
-from utils.mongodb_connector import mongodb_connector
+from utils.audit_writer import audit_writer
+from utils.job_store import job_store, job_owner, PENDING, COMPLETED, TIMEOUT, FAILED
+from utils.idempotency import idempotency_store, idempotency_key
+from utils.prompt_priming import priming_store, prompt_version
+from utils.prompt_templates import prompt_templates, UnknownProfileError, DEFAULT_PROFILE
 import time
 import logging
 
@@ -12,82 +22,350 @@ ai_messaging = Blueprint('ai_messaging', __name__)
 
 GROUP_ID = os.getenv('GROUP_ID')
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Seconds to wait for the AI reply, and the longest a single long-poll request may block
+AI_REPLY_TIMEOUT = int(os.getenv('AI_REPLY_TIMEOUT', '120'))
+AI_JOB_MAX_WAIT = int(os.getenv('AI_JOB_MAX_WAIT', '60'))
+
+# Opt-in: without an Idempotency-Key header, treat a repeat of the same session_id, profile and message
+# within the window as a retry. Off by default, since a user may legitimately send "ok" twice
+IDEMPOTENCY_MESSAGE_HASH = os.getenv('IDEMPOTENCY_MESSAGE_HASH', 'false').lower() == 'true'
+
+# Hosts callback_url may point at: exact names, or *.example.com for any subdomain. Empty allows any
+# public host; private, loopback and link-local addresses are only reachable when their host is listed
+CALLBACK_ALLOWED_HOSTS = [host.strip().lower() for host in os.getenv('CALLBACK_ALLOWED_HOSTS', '').split(',') if host.strip()]
+
 logger = logging.getLogger('AIMessaging')
 
+# Reply futures resolve on the chat's one poller thread, so their done callbacks only hand work to these pools:
+# job bookkeeping (SQLite, audit log, priming) and callback deliveries, so neither a locked database nor a
+# slow callback URL stalls reply delivery for the other waiters
+job_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='AIJobFinisher')
+callback_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='AIJobCallback')
+
 
 def log_message_to_mongodb(timestamp, session_id, message_id, message, reply=None):
+    """Hand the record to the background audit writer; the reply is upserted onto the message's document."""
     document = {
-        "timestamp": timestamp, 
+        "timestamp": timestamp,
         "session_id": session_id,
         "message_id": message_id,
         "message": message,
         "reply": reply
     }
-    logger.info(f"logger message to MongoDB: {document}")
+    if reply is None:
+        audit_writer.record_message(document)
+    else:
+        audit_writer.record_reply(message_id, reply, document)
+
+
+def wants_async(data, prefer_header):
+    """A request opts into the job API with {"async": true} or a 'Prefer: respond-async' header."""
+    return bool(data.get('async')) or 'respond-async' in (prefer_header or '')
+
+
+def host_allowed(host):
+    return any(host == allowed or (allowed.startswith('*.') and host.endswith(allowed[1:]))
+               for allowed in CALLBACK_ALLOWED_HOSTS)
+
+
+def callback_url_error(callback_url):
+    """Why the server must not POST to callback_url, or None if it may."""
+    if not isinstance(callback_url, str):
+        return "callback_url must be a string"
+    parsed = urllib.parse.urlsplit(callback_url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return "callback_url must be an http or https URL"
+    host = parsed.hostname.lower()
+    if host_allowed(host):
+        return None
+    if CALLBACK_ALLOWED_HOSTS:
+        return f"callback_url host {host} is not allowed"
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parsed.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError):
+        return f"callback_url host {host} does not resolve"
+    for address in addresses:
+        if not ipaddress.ip_address(address.split('%')[0]).is_global:
+            return f"callback_url host {host} is not a public address"
+    return None
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """A callback may not bounce the request on to a URL that was never validated."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+callback_opener = urllib.request.build_opener(NoRedirect)
+
+
+def post_callback(callback_url, payload):
+    # Checked again at delivery, in case the name now resolves somewhere else
+    error = callback_url_error(callback_url)
+    if error:
+        logger.error(f"Job callback not delivered: {error}")
+        return
     try:
-        mongodb_connector.insert_message("messages", document)
+        req = urllib.request.Request(callback_url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+        with callback_opener.open(req, timeout=10) as response:
+            logger.info("Job callback delivered with status %s", response.status)
     except Exception as e:
-        logger.error(f"Failed to log message to MongoDB: {e}")
+        logger.error(f"Failed to deliver job callback: {e}")
 
 
-def read_file_content(filename):
-    """Utility function to read content from a file."""
+def job_response(job):
+    """Public view of a stored job."""
+    response = {"job_id": job['id'], "status": job['status']}
+    if job['result']:
+        response["message"] = job['result'].get("message")
+    if job['error']:
+        response["error"] = job['error']
+    return response
+
+
+def finish_ai_job(future, timestamp, session_id, unique_id, user_message, callback_url):
+    """Runs on job_executor once the reply arrived or timed out."""
     try:
-        with open(filename, 'r') as file:
-            return file.read().strip()
-    except FileNotFoundError:
-        return None
+        reply = future.result()
+    except Exception:
+        reply = None
+    if reply:
+        job_store.complete(unique_id, reply)
+        if os.getenv('ENABLE_MONGODB', 'false').lower() == 'true':
+            log_message_to_mongodb(timestamp, session_id, unique_id, user_message, reply=reply)
+    else:
+        job_store.fail(unique_id, "Timeout. Try again or contact administrator", status=TIMEOUT)
+    if callback_url:
+        callback_executor.submit(post_callback, callback_url, job_response(job_store.get(unique_id)))
 
-@ai_messaging.route('/send-ai-message', methods=['POST'])
-@require_api_key
-def send_fixed_message():
-    logger.info("Received request to send AI message")
-    data = request.json
+
+def request_idempotency_key(api_key, header, session_id, profile, user_message):
+    """Key identifying retries of a request, scoped to the caller's API key; None if deduplication is off."""
+    if header:
+        return idempotency_key('header', api_key, header)
+    if IDEMPOTENCY_MESSAGE_HASH:
+        return idempotency_key('message', api_key, session_id, profile, user_message)
+    return None
+
+
+def find_original_job(key, unique_id):
+    """Claim key for unique_id. Returns the earlier job a retry should join, or None if this request owns the key."""
+    owner = idempotency_store.claim(key, unique_id)
+    while owner != unique_id:
+        job = job_store.get(owner)
+        if job is not None and job['status'] in (PENDING, COMPLETED):
+            return job
+        # The earlier attempt failed or timed out, so this retry sends again
+        if idempotency_store.replace(key, owner, unique_id):
+            return None
+        owner = idempotency_store.claim(key, unique_id)
+    return None
+
+
+# The helpers below build (body, status[, headers]) without touching the request or response objects,
+# so the Flask handlers here and the Quart ones in async_messaging.py answer identically
+
+def accepted_reply(job_id, status=PENDING):
+    body = {
+        "job_id": job_id,
+        "status": status,
+        "status_url": f"/ai-jobs/{job_id}",
+        "events_url": f"/ai-jobs/{job_id}/events",
+    }
+    return body, 202, {'Location': f"/ai-jobs/{job_id}"}
+
+
+def reply_body(reply):
+    """Response body and status for a synchronous request, given the reply or None on timeout."""
+    if reply:
+        return {"message": reply.get("message")}, 200
+    logger.error("Timeout. Try again or contact administrator")
+    return {"message": "Timeout. Try again or contact administrator"}, 500
+
+
+def job_reply(job):
+    return job['result'] if job is not None and job['status'] == COMPLETED else None
+
+
+def replay_reply(job, finished_job=None):
+    """Answer a retry from the original job instead of sending the prompt again.
+
+    Async retries get the job's status; synchronous ones pass the job as it was
+    once finished (or after AI_REPLY_TIMEOUT) and get its reply.
+    """
+    logger.info("Retry mapped onto job %s", job['id'])
+    if finished_job is None:
+        body, status, headers = accepted_reply(job['id'], job['status'])
+    else:
+        (body, status), headers = reply_body(job_reply(finished_job)), {}
+    return body, status, dict(headers, **{'Idempotent-Replayed': 'true'})
+
+
+def job_status_reply(job):
+    """Body and status for GET /ai-jobs/<id>."""
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return job_response(job), 500 if job['status'] in (TIMEOUT, FAILED) else 200
+
+
+def prepare_ai_request(data):
+    """Validate a /send-ai-message body and look up its prompt.
+
+    Returns (begin_ai_request arguments taken from the body, None), or (None,
+    (error body, status)). It resolves callback_url's host, so async callers
+    run it in an executor.
+    """
     user_message = data.get('message')
     session_id = data.get('session_id')
-    
+    callback_url = data.get('callback_url')
+    profile = data.get('profile', DEFAULT_PROFILE)
 
     if not user_message or not session_id:
         logger.error("Missing message or chat_id")
-        return jsonify({"error": "Missing message or chat_id"}), 400
+        return None, ({"error": "Missing message or chat_id"}, 400)
 
-    #Get the current timestamp
-    timestamp = int(time.time())
+    callback_error = callback_url_error(callback_url) if callback_url else None
+    if callback_error:
+        logger.error(callback_error)
+        return None, ({"error": callback_error}, 400)
 
-    # Reading content from files
+    # Prompt and instructions come from the template cache, reloaded only when the files change
     try:
-        prompt = read_file_content('prompt.txt')
-        instructions = read_file_content('instructions.txt')
+        prefix = prompt_templates.prefix(profile)
+    except UnknownProfileError:
+        logger.error("Unknown prompt profile: %s", profile)
+        return None, ({"error": f"Unknown prompt profile: {profile}"}, 400)
     except Exception as e:
         logger.error(f"Failed to read content from files: {e}")
-        return jsonify({"message": "Failed to read content from files"}), 500
+        return None, ({"message": "Failed to read content from files"}, 500)
+    return dict(prefix=prefix, session_id=session_id, profile=profile, user_message=user_message, callback_url=callback_url), None
 
+
+def prime_prompt(prefix, session_id, profile):
+    """The prompt text to send and, if this message primes its scope, (scope, version).
+
+    With PROMPT_PRIMING on, only the first message of a scope carries the full
+    prompt; every message names the prompt version it was written against.
+    """
+    if not priming_store.enabled:
+        return prefix, None
+    version = prompt_version(prefix)
+    scope = priming_store.scope_for(session_id, profile)
+    if priming_store.claim(scope, version):
+        return f"{prefix}prompt_version: {version}\n", (scope, version)
+    return f"prompt_version: {version}\n", None
+
+
+def forget_failed_priming(future, scope, version):
+    try:
+        reply = future.result()
+    except Exception:
+        reply = None
+    if not reply:
+        priming_store.forget(scope, version)
+
+
+def begin_ai_request(prefix, timestamp, session_id, profile, user_message, callback_url, api_key, idempotency_header):
+    """Create the job and send the prompt, unless this is a retry of a request still in flight.
+
+    Returns (original job or None, job id, future for the reply). Shared by the
+    Flask handler and the ASGI one in async_messaging.py; it blocks on SQLite,
+    so async callers run it in an executor.
+    """
+    # Every request is a job, so retries from any worker process can find it by idempotency key
     unique_id = str(uuid.uuid4())
-    formatted_message = f"{prompt}\n{instructions}\nid: {unique_id}\nsession_id: {session_id}\nmessage: {user_message}"
+    job_store.create(unique_id, 'ai-message', AI_REPLY_TIMEOUT, callback_url, owner=job_owner(api_key))
+    key = request_idempotency_key(api_key, idempotency_header, session_id, profile, user_message)
+    if key is not None:
+        original = find_original_job(key, unique_id)
+        if original is not None:
+            job_store.delete(unique_id)
+            return original, original['id'], None
+
+    prefix, primed = prime_prompt(prefix, session_id, profile)
+    formatted_message = f"{prefix}id: {unique_id}\nsession_id: {session_id}\nmessage: {user_message}"
     if os.getenv('ENABLE_MONGODB', 'false').lower() == 'true':
-        logger.info(f"Logging message to MongoDB: {formatted_message}")
+        logger.info("Logging message to MongoDB")
         try:
             log_message_to_mongodb(timestamp, session_id, unique_id, user_message)
         except Exception as e:
             logger.error(f"Failed to log message to MongoDB: {e}")
 
-    # Sending the formatted message
-    enqueue_message(GROUP_ID, formatted_message)
+    # Start listening for the reply before the message can possibly be answered
+    reply_future = expect_skype_reply(GROUP_ID, unique_id, AI_REPLY_TIMEOUT)
+    # Stores the reply on the job (and logs it to MongoDB) whether or not the caller waits for it
+    reply_future.add_done_callback(lambda future: job_executor.submit(
+        finish_ai_job, future, timestamp, session_id, unique_id, user_message, callback_url))
+    if primed is not None:
+        reply_future.add_done_callback(lambda future: job_executor.submit(forget_failed_priming, future, *primed))
+
+    # Sending the formatted message; it carries its own id: line, so it is never merged with others
+    enqueue_message(GROUP_ID, formatted_message, coalesce=False)
     logger.info("Message enqueued successfully")
+    return None, unique_id, reply_future
 
 
+@ai_messaging.route('/send-ai-message', methods=['POST'])
+@require_api_key
+def send_fixed_message():
+    logger.info("Received request to send AI message")
+    data = request.json or {}
+    fields, error = prepare_ai_request(data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+
+    #Get the current timestamp
+    timestamp = int(time.time())
+
+    run_async = wants_async(data, request.headers.get('Prefer')) or fields['callback_url']
+    original, unique_id, reply_future = begin_ai_request(
+        timestamp=timestamp, api_key=request.headers.get('x-api-key'),
+        idempotency_header=request.headers.get('Idempotency-Key'), **fields)
+    if original is not None:
+        finished = None if run_async else job_store.wait(unique_id, AI_REPLY_TIMEOUT)
+        body, status, headers = replay_reply(original, finished)
+        return jsonify(body), status, headers
+
+    if run_async:
+        body, status, headers = accepted_reply(unique_id)
+        return jsonify(body), status, headers
+
     # Attempting to fetch the reply
-    reply = fetch_skype_reply(GROUP_ID, unique_id)
-    if reply:
-        if reply and os.getenv('ENABLE_MONGODB', 'false').lower() == 'true':
-            logger.info(f"Logging reply to MongoDB: {reply}")
-            try:
-                log_message_to_mongodb(timestamp, session_id, unique_id, user_message, reply=reply)
-            except Exception as e: 
-                logger.error(f"Failed to log reply to MongoDB: {e}")
-            response_message = {"message": reply.get("message")}
-            return jsonify(response_message), 200
-    else:
-        logger.error("Timeout. Try again or contact administrator")
-        return jsonify({"message": "Timeout. Try again or contact administrator"}), 500
+    reply = fetch_skype_reply(GROUP_ID, unique_id, AI_REPLY_TIMEOUT, future=reply_future)
+    body, status = reply_body(reply)
+    return jsonify(body), status
+
+
+@ai_messaging.route('/ai-jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_ai_job(job_id):
+    """Job status; ?wait=<seconds> long-polls until the job is finished. Only the API key that created the job sees it."""
+    owner = job_owner(request.headers.get('x-api-key'))
+    wait = min(request.args.get('wait', 0, type=float), AI_JOB_MAX_WAIT)
+    job = job_store.wait(job_id, wait, owner=owner) if wait > 0 else job_store.get(job_id, owner)
+    body, status = job_status_reply(job)
+    return jsonify(body), status
+
+
+@ai_messaging.route('/ai-jobs/<job_id>/events', methods=['GET'])
+@require_api_key
+def stream_ai_job(job_id):
+    """Server-Sent Events stream: keep-alive comments while pending, then one 'result' event."""
+    owner = job_owner(request.headers.get('x-api-key'))
+    if job_store.get(job_id, owner) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def events():
+        while True:
+            job = job_store.wait(job_id, 15, owner=owner)
+            if job is None or job['status'] != PENDING:
+                break
+            yield ": keep-alive\n\n"
+        payload = job_response(job) if job else {"job_id": job_id, "error": "Job not found"}
+        yield f"event: result\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
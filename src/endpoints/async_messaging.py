@@ -0,0 +1,117 @@
+# async_messaging.py
+"""Quart versions of the messaging endpoints, served by asgi.py.
+
+Waiting for an AI reply awaits the reply dispatcher's future, so a pending
+request costs a coroutine instead of a thread. Blocking work (skpy sends,
+SQLite, the API key lookup) runs on a bounded thread pool.
+"""
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from quart import Blueprint, request, jsonify
+from utils.skype_messaging import REPLY_WAIT_MARGIN, give_up_on_reply
+from utils.api_key_manager import api_key_error
+from utils.job_store import job_store, job_owner, PENDING
+from endpoints.ai_messaging import (GROUP_ID, AI_REPLY_TIMEOUT, AI_JOB_MAX_WAIT, prepare_ai_request, begin_ai_request, wants_async,
+                                    accepted_reply, replay_reply, reply_body, job_status_reply)
+from endpoints.custom_messaging import custom_message_reply
+import logging
+
+logger = logging.getLogger('AsyncMessaging')
+
+async_messaging = Blueprint('async_messaging', __name__)
+
+# Threads for blocking calls; requests waiting for a reply do not hold one
+ASGI_BLOCKING_WORKERS = int(os.getenv('ASGI_BLOCKING_WORKERS', '32'))
+
+blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix='AsyncBlocking')
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, functools.partial(func, *args))
+
+
+def require_api_key(view_function):
+    @wraps(view_function)
+    async def decorated_function(*args, **kwargs):
+        error = await run_blocking(api_key_error, request.headers.get('x-api-key'))
+        if error:
+            body, status = error
+            return jsonify(body), status
+        return await view_function(*args, **kwargs)
+    return decorated_function
+
+
+async def await_reply(unique_id, future, timeout):
+    """The parsed reply, or None once the dispatcher gives up on it.
+
+    The dispatcher's future also completes the job, so it is shielded: a client
+    disconnect cancels only this request's wait, and the job still gets the reply.
+    """
+    try:
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout + REPLY_WAIT_MARGIN)
+    except asyncio.CancelledError:
+        logger.info("Client went away; the job keeps waiting for the reply")
+        raise
+    except TimeoutError:
+        return give_up_on_reply(GROUP_ID, unique_id, future)
+
+
+async def wait_for_job(job_id, timeout, poll_interval=0.5, owner=None):
+    """Async counterpart of job_store.wait, for jobs owned by another request or process."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await run_blocking(job_store.get, job_id, owner)
+        if job is None or job['status'] != PENDING or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+@async_messaging.route('/send-ai-message', methods=['POST'])
+@require_api_key
+async def send_fixed_message():
+    logger.info("Received request to send AI message")
+    data = await request.get_json() or {}
+    fields, error = await run_blocking(prepare_ai_request, data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+
+    timestamp = int(time.time())
+    run_async = wants_async(data, request.headers.get('Prefer')) or fields['callback_url']
+    original, unique_id, reply_future = await run_blocking(functools.partial(
+        begin_ai_request, timestamp=timestamp, api_key=request.headers.get('x-api-key'),
+        idempotency_header=request.headers.get('Idempotency-Key'), **fields))
+    if original is not None:
+        finished = None if run_async else await wait_for_job(unique_id, AI_REPLY_TIMEOUT)
+        body, status, headers = replay_reply(original, finished)
+        return jsonify(body), status, headers
+
+    if run_async:
+        body, status, headers = accepted_reply(unique_id)
+        return jsonify(body), status, headers
+
+    body, status = reply_body(await await_reply(unique_id, reply_future, AI_REPLY_TIMEOUT))
+    return jsonify(body), status
+
+
+@async_messaging.route('/send-custom-message', methods=['POST'])
+@require_api_key
+async def send_custom_message():
+    logger.info("Received request to send custom message")
+    body, status = await run_blocking(custom_message_reply, await request.get_json() or {})
+    return jsonify(body), status
+
+
+@async_messaging.route('/ai-jobs/<job_id>', methods=['GET'])
+@require_api_key
+async def get_ai_job(job_id):
+    """Job status; ?wait=<seconds> long-polls without holding a thread."""
+    owner = job_owner(request.headers.get('x-api-key'))
+    wait = min(request.args.get('wait', 0, type=float), AI_JOB_MAX_WAIT)
+    job = await wait_for_job(job_id, wait, owner=owner) if wait > 0 else await run_blocking(job_store.get, job_id, owner)
+    body, status = job_status_reply(job)
+    return jsonify(body), status
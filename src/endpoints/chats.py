@@ -0,0 +1,37 @@
+# chats.py
+from flask import Blueprint, request, jsonify
+from utils.skype_messaging import skype_pool
+from utils.chat_directory import ChatDirectory
+from utils.api_key_manager import require_api_key
+import logging
+
+logger = logging.getLogger('Chats')
+
+chats = Blueprint('chats', __name__)
+
+CHATS_MAX_PAGE_SIZE = 500
+
+# Uses the primary account's session, so listing chats never costs a login of its own
+chat_directory = ChatDirectory(skype_pool.session_for())
+
+
+@chats.route('/chats', methods=['GET'])
+@require_api_key
+def list_chats():
+    """Known chats, most recently active first. Query parameters: q (topic or id search), offset, limit."""
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(CHATS_MAX_PAGE_SIZE, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+
+    try:
+        chat_directory.ensure_loaded()
+    except Exception as e:
+        logger.error(f"Failed to load chat directory: {e}")
+        return jsonify({"error": "Failed to load chats"}), 503
+    chat_directory.start_refresher()
+
+    total, entries = chat_directory.search(request.args.get('q'), offset, limit)
+    return jsonify({"total": total, "offset": offset, "limit": limit, "refreshed_at": chat_directory.refreshed_at,
+                    "chats": entries}), 200
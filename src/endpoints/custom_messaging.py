@@ -1,29 +1,163 @@
 # custom_messaging.py
+import os
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Blueprint, request, jsonify
-from utils.skype_messaging import send_skype_message
+from utils.skype_messaging import send_skype_message, enqueue_message
 from utils.api_key_manager import require_api_key
+from utils.job_store import job_store, job_owner, FAILED, TIMEOUT
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('CustomMessaging')
 
 custom_messaging = Blueprint('custom_messaging', __name__)
 
-@custom_messaging.route('/send-custom-message', methods=['POST'])
-@require_api_key
-def send_custom_message():
-    logger.info("Received request to send custom message")
-    data = request.json
+# Batch sends share one bounded pool per process, however many batches are running.
+# Each group's items go to a single task, so they are posted one after another in batch order
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+BATCH_SEND_WORKERS = int(os.getenv('BATCH_SEND_WORKERS', '8'))
+BATCH_JOB_TIMEOUT = int(os.getenv('BATCH_JOB_TIMEOUT', '3600'))
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_SEND_WORKERS, thread_name_prefix='BatchSender')
+
+
+def custom_message_reply(data):
+    """Send or queue one /send-custom-message body; returns the response body and status.
+
+    Blocks on the Skype send, so the ASGI handler in async_messaging.py runs it in an executor.
+    """
     group_id = data.get('group_id')
     message = data.get('message')
 
     if not group_id or not message:
         logger.error("Missing group_id or message")
-        return jsonify({"error": "Missing group_id or message"}), 400
+        return {"error": "Missing group_id or message"}, 400
+
+    # {"queue": true} hands the message to the rate-limited sender, where it may be coalesced with others
+    if data.get('queue'):
+        enqueue_message(group_id, message)
+        logger.info("Message queued")
+        return {"success": "Message queued"}, 202
 
     if send_skype_message(group_id, message):
         logger.info("Message sent successfully")
-        return jsonify({"success": "Message sent successfully"}), 200
+        return {"success": "Message sent successfully"}, 200
     else:
         logger.error("Failed to send message")
-        return jsonify({"error": "Failed to send message"}), 500
+        return {"error": "Failed to send message"}, 500
+
+
+@custom_messaging.route('/send-custom-message', methods=['POST'])
+@require_api_key
+def send_custom_message():
+    logger.info("Received request to send custom message")
+    body, status = custom_message_reply(request.json or {})
+    return jsonify(body), status
+
+
+def parse_batch_items(data):
+    """Accept {"items": [{"group_id", "message"}, ...]} or {"message", "group_ids": [...]}."""
+    if 'items' in data:
+        items = data.get('items')
+        if not isinstance(items, list):
+            return None
+        return [(item.get('group_id'), item.get('message')) if isinstance(item, dict) else (None, None) for item in items]
+    group_ids = data.get('group_ids')
+    if not isinstance(group_ids, list):
+        return None
+    return [(group_id, data.get('message')) for group_id in group_ids]
+
+
+def send_batch_item(group_id, message):
+    try:
+        if send_skype_message(group_id, message):
+            return {"group_id": group_id, "status": "sent"}
+        return {"group_id": group_id, "status": "failed", "error": "Failed to send message"}
+    except Exception as e:
+        logger.error(f"Unexpected error sending batch item: {e}")
+        return {"group_id": group_id, "status": "failed", "error": "Failed to send message"}
+
+
+class BatchTracker:
+    """Collects per-item results and stores the batch once the last item finishes."""
+
+    def __init__(self, batch_id, size):
+        self.batch_id = batch_id
+        self.results = [None] * size
+        self.remaining = size
+        self._lock = threading.Lock()
+
+    def item_done(self, index, result):
+        with self._lock:
+            self.results[index] = result
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            job_store.complete(self.batch_id, batch_summary(self.results))
+
+
+def batch_summary(results):
+    sent = sum(1 for result in results if result["status"] == "sent")
+    return {"sent": sent, "failed": len(results) - sent, "results": results}
+
+
+def send_group_items(group_id, entries, on_result):
+    for index, message in entries:
+        on_result(index, send_batch_item(group_id, message))
+
+
+def submit_batch(items, on_result):
+    """Fan items out to the batch pool, one task per group; invalid items are answered immediately."""
+    by_group = {}
+    for index, (group_id, message) in enumerate(items):
+        if not group_id or not message or not isinstance(group_id, str):
+            on_result(index, {"group_id": group_id, "status": "invalid", "error": "Missing group_id or message"})
+            continue
+        by_group.setdefault(group_id, []).append((index, message))
+    return [batch_executor.submit(send_group_items, group_id, entries, on_result) for group_id, entries in by_group.items()]
+
+
+@custom_messaging.route('/send-custom-messages', methods=['POST'])
+@require_api_key
+def send_custom_messages():
+    """Send many messages in one request. With {"async": true} this returns 202 and a batch id."""
+    logger.info("Received request to send custom message batch")
+    data = request.json or {}
+    items = parse_batch_items(data)
+    if not items:
+        logger.error("Missing items or group_ids")
+        return jsonify({"error": "Missing items, or message and group_ids"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        logger.error(f"Batch of {len(items)} items exceeds the limit of {BATCH_MAX_ITEMS}")
+        return jsonify({"error": f"Too many items, the limit is {BATCH_MAX_ITEMS}"}), 400
+
+    if data.get('async'):
+        batch_id = str(uuid.uuid4())
+        job_store.create(batch_id, 'custom-batch', BATCH_JOB_TIMEOUT, owner=job_owner(request.headers.get('x-api-key')))
+        tracker = BatchTracker(batch_id, len(items))
+        submit_batch(items, on_result=tracker.item_done)
+        logger.info(f"Batch {batch_id} with {len(items)} items accepted")
+        response = jsonify({"batch_id": batch_id, "status": "pending", "status_url": f"/custom-batches/{batch_id}"})
+        response.headers['Location'] = f"/custom-batches/{batch_id}"
+        return response, 202
+
+    results = [None] * len(items)
+    wait(submit_batch(items, on_result=results.__setitem__))
+    summary = batch_summary(results)
+    logger.info(f"Batch sent: {summary['sent']} sent, {summary['failed']} failed")
+    return jsonify(summary), 200 if summary["failed"] == 0 else 207
+
+
+@custom_messaging.route('/custom-batches/<batch_id>', methods=['GET'])
+@require_api_key
+def get_custom_batch(batch_id):
+    job = job_store.get(batch_id, job_owner(request.headers.get('x-api-key')))
+    if job is None or job['kind'] != 'custom-batch':
+        return jsonify({"error": "Batch not found"}), 404
+    response = {"batch_id": batch_id, "status": job['status']}
+    if job['result']:
+        response.update(job['result'])
+    if job['error']:
+        response["error"] = job['error']
+    return jsonify(response), 500 if job['status'] in (FAILED, TIMEOUT) else 200
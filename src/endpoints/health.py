@@ -0,0 +1,22 @@
+# health.py
+from flask import Blueprint, jsonify
+from utils.mongodb_connector import mongodb_connector
+from utils.storage import sqlite_pool_stats
+from utils.skype_messaging import skype_pool
+import logging
+
+logger = logging.getLogger('Health')
+
+health = Blueprint('health', __name__)
+
+@health.route('/health', methods=['GET'])
+def get_health():
+    """Liveness plus storage pool utilization and Skype account health. Unauthenticated so load balancers can use it."""
+    status = {"status": "ok", "sqlite": sqlite_pool_stats(), "skype_accounts": skype_pool.stats()}
+    if mongodb_connector.enabled:
+        mongodb_ok = mongodb_connector.ping()
+        status["mongodb"] = dict(mongodb_connector.pool_stats(), ok=mongodb_ok)
+        if not mongodb_ok:
+            status["status"] = "degraded"
+            return jsonify(status), 503
+    return jsonify(status), 200
@@ -0,0 +1,63 @@
+# metrics.py
+import time
+from flask import Blueprint, Response
+from utils.metrics import registry
+from utils.skype_messaging import (init_messaging, skype_pool, reply_dispatchers, reply_dispatchers_lock, metrics_group,
+                                   MESSAGE_QUEUE_BACKEND)
+from utils.audit_writer import audit_writer
+from utils.api_key_manager import api_key_cache
+from utils.mongodb_connector import mongodb_connector
+import logging
+
+logger = logging.getLogger('Metrics')
+
+metrics = Blueprint('metrics', __name__)
+
+
+def by_metrics_group(values, combine=sum):
+    """Fold per-group values into the bounded label set of metrics_group."""
+    grouped = {}
+    for group_id, value in values.items():
+        grouped.setdefault(metrics_group(group_id), []).append(value)
+    return {label: combine(group_values) for label, group_values in grouped.items()}
+
+
+def queue_depths():
+    return by_metrics_group(init_messaging().backend.depth())
+
+
+def oldest_queued_ages():
+    now = time.time()
+    return by_metrics_group({group_id: now - enqueued_at for group_id, enqueued_at in init_messaging().backend.oldest().items()},
+                            combine=max)
+
+
+def pending_replies():
+    with reply_dispatchers_lock:
+        dispatchers = list(reply_dispatchers.values())
+    return by_metrics_group({dispatcher.group_id: dispatcher.pending() for dispatcher in dispatchers})
+
+
+# Point-in-time values, read from their owners at scrape time rather than tracked on every change.
+# Every process sees the whole SQLite queue, so only the in-memory queue is added up across processes.
+shared_queue = MESSAGE_QUEUE_BACKEND != 'memory'
+registry.gauge('skype_send_queue_depth', 'Messages waiting to be sent', ('group_id',), func=queue_depths,
+               aggregate=None if shared_queue else 'sum')
+registry.gauge('skype_send_queue_oldest_seconds', 'Age of the oldest waiting message', ('group_id',), func=oldest_queued_ages,
+               aggregate=None if shared_queue else 'max')
+registry.gauge('skype_reply_waiters', 'Requests waiting for an AI reply', ('group_id',), func=pending_replies)
+registry.gauge('skype_account_healthy', '1 while the account is in rotation in every process', ('account',),
+               func=lambda: {stats["account"]: int(stats["healthy"]) for stats in skype_pool.stats()}, aggregate='min')
+registry.gauge('audit_writer_queued', 'Audit records waiting to be written', func=lambda: audit_writer.stats()["queued"])
+registry.gauge('audit_writer_dropped', 'Audit records dropped because the buffer was full',
+               func=lambda: audit_writer.stats()["dropped"])
+registry.gauge('api_key_cache_entries', 'Cached API key lookups', func=lambda: api_key_cache.stats()["size"])
+if mongodb_connector.enabled:
+    registry.gauge('mongodb_pool_checked_out', 'MongoDB connections in use',
+                   func=lambda: mongodb_connector.pool_stats()["checked_out"])
+
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition format, totalled over every worker process. Unauthenticated like /health, for scrapers."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,15 @@
+# queue_status.py
+from flask import Blueprint, jsonify
+from utils.skype_messaging import get_queue_stats
+from utils.api_key_manager import require_api_key
+import logging
+
+logger = logging.getLogger('QueueStatus')
+
+queue_status = Blueprint('queue_status', __name__)
+
+@queue_status.route('/queue-stats', methods=['GET'])
+@require_api_key
+def get_queue_status():
+    """Queue depth and queue wait times (seconds) per group."""
+    return jsonify({"groups": get_queue_stats()}), 200
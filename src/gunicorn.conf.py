@@ -0,0 +1,23 @@
+# gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', str(multiprocessing.cpu_count())))
+# Synchronous /send-ai-message requests hold a thread while they wait for the reply
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', str(int(os.getenv('AI_REPLY_TIMEOUT', '120')) + 60)))
+
+# Importing the app opens no connections and starts no threads, so it is loaded
+# once in the master and forked; each worker then initializes itself below.
+preload_app = True
+
+
+def post_worker_init(worker):
+    """Runs in each worker after fork, once gunicorn has installed the worker's signal handlers."""
+    from app import init_worker
+    from utils.prompt_templates import prompt_templates
+    init_worker()
+    # gunicorn resets SIGHUP in workers; reinstall the prompt template reload
+    prompt_templates.install_sighup_handler()
@@ -1,39 +1,64 @@
-import sqlite3
 import secrets
+import sqlite3
+import threading
 import argparse
+import time
 from functools import wraps
 from flask import request, jsonify
 import os
 from utils.mongodb_connector import mongodb_connector
+from utils.ttl_cache import TTLCache
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection
+from utils.metrics import registry
+from utils.logging_setup import setup_logging
 from dotenv import load_dotenv
 import logging
 
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('APIKeyManager')
 
 # Define the path to the SQLite database
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DATABASE_PATH = os.path.join(BASE_DIR, 'db', 'api_keys.db')
+DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'api_keys.db')
 
 # Use MongoDB if ENABLE_MONGODB is set to 'true', else use SQLite
 USE_MONGODB = os.getenv('ENABLE_MONGODB', 'false').lower() == 'true'
 
+# In-memory cache of key lookups, so auth does not hit the database on every request.
+# Invalid keys are cached for a shorter time so a freshly added key is picked up quickly.
+API_KEY_CACHE_TTL = float(os.getenv('API_KEY_CACHE_TTL', '60'))
+API_KEY_CACHE_NEGATIVE_TTL = float(os.getenv('API_KEY_CACHE_NEGATIVE_TTL', '5'))
+API_KEY_CACHE_SIZE = int(os.getenv('API_KEY_CACHE_SIZE', '1024'))
+# The cache lives in each process, so revocations are signalled through a generation counter in the key
+# store; every process reads it at most this often and clears its cache when it changed
+API_KEY_REVOCATION_CHECK_INTERVAL = float(os.getenv('API_KEY_REVOCATION_CHECK_INTERVAL', '1'))
+
+api_key_cache = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+
+key_check_latency = registry.histogram('api_key_check_seconds', 'API key validation latency by cache outcome', ('cache',))
+key_checks = registry.counter('api_key_checks_total', 'API key validations by result', ('result',))
+
+_revocation_generation = None
+_revocation_checked_at = 0.0
+_revocation_lock = threading.Lock()
+
 # Database initialization
 def init_db():
     if not USE_MONGODB:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('''
+        conn = get_sqlite_connection(DATABASE_PATH)
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS api_keys (
                 key TEXT PRIMARY KEY,
                 active INTEGER NOT NULL CHECK (active IN (0,1))
             )
         ''')
-        conn.commit()
-        conn.close()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS api_key_revocations (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generation INTEGER NOT NULL
+            )
+        ''')
         logger.info("SQLite database initialized")
 
 # Generate a new API key
@@ -51,53 +76,112 @@ def add_api_key():
             logger.error("Failed to add API key, MongoDB error")
             return "Failed to add API key, MongoDB error"
     else:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('INSERT INTO api_keys (key, active) VALUES (?, ?)', (key, 1))
-        conn.commit()
-        conn.close()
+        conn = get_sqlite_connection(DATABASE_PATH)
+        conn.execute('INSERT INTO api_keys (key, active) VALUES (?, ?)', (key, 1))
         logger.info(f"SQLite API key added")
+    api_key_cache.invalidate(key)
     return key
 
 # Remove (deactivate) an API key
 def remove_api_key(key):
     if USE_MONGODB:
-        mongodb_connector.db.api_keys.update_one({"key": key}, {"$set": {"active": 0}})
+        mongodb_connector.ensure_connected().api_keys.update_one({"key": key}, {"$set": {"active": 0}})
         logger.info(f"Mongodb API key removed:")
     else:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('UPDATE api_keys SET active = 0 WHERE key = ?', (key,))
-        conn.commit()
-        conn.close()
+        conn = get_sqlite_connection(DATABASE_PATH)
+        conn.execute('UPDATE api_keys SET active = 0 WHERE key = ?', (key,))
         logger.info(f"SQLite API key removed")
+    api_key_cache.invalidate(key)
+    bump_revocation_generation()
 
-# Check if an API key is valid and active
+# Tell every process caching keys that a key was revoked
+def bump_revocation_generation():
+    if USE_MONGODB:
+        mongodb_connector.ensure_connected().api_key_revocations.update_one(
+            {"_id": "generation"}, {"$inc": {"generation": 1}}, upsert=True)
+    else:
+        conn = get_sqlite_connection(DATABASE_PATH)
+        conn.execute('INSERT INTO api_key_revocations (id, generation) VALUES (1, 1) '
+                     'ON CONFLICT(id) DO UPDATE SET generation = generation + 1')
+
+def read_revocation_generation():
+    if USE_MONGODB:
+        document = mongodb_connector.ensure_connected().api_key_revocations.find_one({"_id": "generation"})
+        return document["generation"] if document else 0
+    try:
+        row = get_sqlite_connection(DATABASE_PATH).execute('SELECT generation FROM api_key_revocations WHERE id = 1').fetchone()
+    except sqlite3.OperationalError as e:
+        # Databases created before revocation tracking get the table from the next init_db()
+        if 'no such table' in str(e):
+            return 0
+        raise
+    return row[0] if row else 0
+
+# Clear the cache if any process revoked a key since the last check; reads the store at most once per interval
+def check_revocations():
+    global _revocation_generation, _revocation_checked_at
+    if time.monotonic() - _revocation_checked_at < API_KEY_REVOCATION_CHECK_INTERVAL:
+        return
+    with _revocation_lock:
+        if time.monotonic() - _revocation_checked_at < API_KEY_REVOCATION_CHECK_INTERVAL:
+            return
+        _revocation_checked_at = time.monotonic()
+        try:
+            generation = read_revocation_generation()
+        except Exception as e:
+            logger.error(f"Failed to check for revoked API keys: {e}")
+            return
+        if _revocation_generation is not None and generation != _revocation_generation:
+            api_key_cache.clear()
+            logger.info("API key revoked elsewhere, cache cleared")
+        _revocation_generation = generation
+
+# Check if an API key is valid and active, using the in-memory cache when possible
 def is_valid_key(key):
+    start = time.perf_counter()
+    check_revocations()
+    result = api_key_cache.get(key)
+    cache = 'hit'
+    if result is None:
+        cache = 'miss'
+        result = lookup_api_key(key)
+        api_key_cache.set(key, result, ttl=None if result else API_KEY_CACHE_NEGATIVE_TTL)
+    key_check_latency.observe(time.perf_counter() - start, cache=cache)
+    key_checks.inc(result='valid' if result else 'invalid')
+    return result
+
+# Look up an API key in the database, bypassing the cache
+def lookup_api_key(key):
     if USE_MONGODB:
-        result = mongodb_connector.db.api_keys.find_one({"key": key, "active": 1})
+        result = mongodb_connector.ensure_connected().api_keys.find_one({"key": key, "active": 1})
         return result is not None
     else:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('SELECT active FROM api_keys WHERE key = ? AND active = 1', (key,))
-        result = c.fetchone()
-        conn.close()
+        conn = get_sqlite_connection(DATABASE_PATH)
+        result = conn.execute('SELECT active FROM api_keys WHERE key = ? AND active = 1', (key,)).fetchone()
         logger.info(f"API key checked")
         return result is not None
 
+def api_key_error(api_key):
+    """Error body and status for a request carrying this x-api-key header, or None if the key is valid.
+
+    Shared by require_api_key and its ASGI counterpart; it may hit the key store, so async callers run it in an executor.
+    """
+    logger.info("Checking API key")
+    if api_key and is_valid_key(api_key):
+        logger.info("Valid API key")
+        return None
+    logger.error("Invalid or missing API key")
+    return {"error": "Invalid or missing API key"}, 401
+
 # Decorator for API protection
 def require_api_key(view_function):
     @wraps(view_function)
     def decorated_function(*args, **kwargs):
-        logger.info("Checking API key")
-        api_key = request.headers.get('x-api-key')
-        if api_key and is_valid_key(api_key):
-            logger.info("Valid API key")
-            return view_function(*args, **kwargs)
-        else:
-            logger.error("Invalid or missing API key")
-            return jsonify({"error": "Invalid or missing API key"}), 401
+        error = api_key_error(request.headers.get('x-api-key'))
+        if error:
+            body, status = error
+            return jsonify(body), status
+        return view_function(*args, **kwargs)
     logger.info("API key checked")
     return decorated_function
 
@@ -116,7 +200,7 @@ def main():
         print(f'New API key: {key}')
     elif args.remove:
         remove_api_key(args.remove)
-        logger.info(f"API key removed: {args.remove}")
+        logger.info("API key removed")
         print(f'API key removed: {args.remove}')
     elif args.check:
         is_valid = is_valid_key(args.check)
@@ -126,6 +210,7 @@ def main():
 
 
 if __name__ == '__main__':
+    setup_logging()
     if not USE_MONGODB:
         logger.info("Using SQLite")
         init_db()
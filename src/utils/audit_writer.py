@@ -0,0 +1,128 @@
+# audit_writer.py
+import atexit
+import os
+import queue
+import threading
+import time
+import logging
+from utils.mongodb_connector import mongodb_connector, Insert, Upsert
+
+
+logger = logging.getLogger('AuditWriter')
+
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '100'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1.0'))
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', '10000'))
+# How long a request thread may block when the buffer is full before the record is dropped
+AUDIT_ENQUEUE_TIMEOUT = float(os.getenv('AUDIT_ENQUEUE_TIMEOUT', '0'))
+
+
+class AuditWriter:
+    """Buffers audit records and writes them to MongoDB in batches from a background thread.
+
+    A batch is flushed when it reaches batch_size records or flush_interval
+    seconds after its first record, whichever comes first. When MongoDB falls
+    behind and the buffer is full, new records are dropped and counted rather
+    than blocking request threads.
+    """
+
+    def __init__(self, connector, collection_name='messages', batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, queue_size=AUDIT_QUEUE_SIZE, enqueue_timeout=AUDIT_ENQUEUE_TIMEOUT):
+        self.connector = connector
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # Forked after the writer started: the thread is gone and the buffer belongs to the parent
+                    self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                else:
+                    atexit.register(self.flush)
+                self._thread = threading.Thread(target=self._run, name='AuditWriter', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _put(self, operation):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            if self.enqueue_timeout > 0:
+                self._queue.put(operation, timeout=self.enqueue_timeout)
+            else:
+                self._queue.put_nowait(operation)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Audit buffer full, record dropped (%d dropped so far)", self.dropped)
+
+    def record_message(self, document):
+        self._put(Insert(document))
+
+    def record_reply(self, message_id, reply, document=None):
+        """Attach the reply to the message_id document, creating it from document if it was never written."""
+        update = {"$set": {"reply": reply}}
+        if document:
+            update["$setOnInsert"] = {key: value for key, value in document.items() if key not in ("reply", "message_id")}
+        self._put(Upsert({"message_id": message_id}, update))
+
+    def _drain(self, block):
+        """Collect up to batch_size operations, waiting at most flush_interval after the first one."""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if block and remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # Ordered, so a reply upsert never overtakes the insert of its own message
+        if self.connector.bulk_write(self.collection_name, batch, ordered=True):
+            self.written += len(batch)
+        else:
+            self.failed += len(batch)
+
+    def _run(self):
+        logger.info("Starting audit writer thread...")
+        while True:
+            batch = self._drain(block=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Write everything buffered so far from the calling thread."""
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+audit_writer = AuditWriter(mongodb_connector)
@@ -0,0 +1,136 @@
+# chat_directory.py
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('ChatDirectory')
+
+CHAT_DIRECTORY_REFRESH_INTERVAL = float(os.getenv('CHAT_DIRECTORY_REFRESH_INTERVAL', '300'))
+CHAT_DIRECTORY_FETCH_WORKERS = int(os.getenv('CHAT_DIRECTORY_FETCH_WORKERS', '8'))
+# Pages of recent chats read per refresh; skpy returns a page per call, newest first
+CHAT_DIRECTORY_MAX_PAGES = int(os.getenv('CHAT_DIRECTORY_MAX_PAGES', '20'))
+
+
+def last_activity(chat):
+    """Compose time of the last message, when Skype included it in the recent chats listing."""
+    raw = getattr(chat, 'raw', None) or {}
+    return (raw.get('lastMessage') or {}).get('composetime') or (raw.get('properties') or {}).get('lastimreceivedtime')
+
+
+def restart_recent(skype):
+    """Make the next chats.recent() start over from the most recently active chats.
+
+    skpy follows a sync state link per call, so each call returns the next,
+    older page; dropping the link for the conversations URL rewinds it.
+    """
+    skype.conn.syncStates.pop(("GET", f"{skype.conn.msgsHost}/users/ME/conversations"), None)
+
+
+def describe_chat(chat_id, chat):
+    if hasattr(chat, 'topic'):
+        return {"id": chat_id, "topic": chat.topic, "type": "group", "last_activity": last_activity(chat)}
+    return {"id": chat_id, "topic": getattr(chat, 'userId', None) or "Individual Chat", "type": "individual",
+            "last_activity": last_activity(chat)}
+
+
+class ChatDirectory:
+    """Chat id -> topic, type and last activity, for one Skype session.
+
+    Every refresh rewinds skpy's recent chats listing and reads up to
+    max_pages pages from the most recently active chat down, so topics and
+    last activity stay current; chats older than that keep their last known
+    entry. Group chats listed without a topic are fetched concurrently.
+    """
+
+    def __init__(self, session, workers=CHAT_DIRECTORY_FETCH_WORKERS, refresh_interval=CHAT_DIRECTORY_REFRESH_INTERVAL,
+                 max_pages=CHAT_DIRECTORY_MAX_PAGES):
+        self.session = session
+        self.refresh_interval = refresh_interval
+        self.max_pages = max_pages
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ChatDirectoryFetch')
+        self.entries = {}
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+
+    def _fetch(self, skype, chat_id):
+        # Straight from Skype: the session's chat cache may hold the same topic-less object for an hour
+        try:
+            return describe_chat(chat_id, skype.chats.chat(chat_id))
+        except Exception as e:
+            logger.error(f"Failed to fetch chat {chat_id}: {e}")
+            return None
+
+    def refresh(self):
+        """Merge the most recently active chats into the directory. Returns the number of entries updated."""
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        skype = self.session.get_instance()
+        if skype is None:
+            logger.error("Chat directory refresh skipped, no Skype session")
+            return 0
+        updated = {}
+        missing = []
+        restart_recent(skype)
+        for _ in range(self.max_pages):
+            page = skype.chats.recent()
+            if not page:
+                break
+            for chat_id, chat in page.items():
+                entry = describe_chat(chat_id, chat)
+                if entry["type"] == "group" and not entry["topic"]:
+                    missing.append(chat_id)
+                updated[chat_id] = entry
+        for entry in self.executor.map(lambda chat_id: self._fetch(skype, chat_id), missing):
+            if entry is not None:
+                entry["last_activity"] = entry["last_activity"] or updated[entry["id"]]["last_activity"]
+                updated[entry["id"]] = entry
+        with self._lock:
+            self.entries.update(updated)
+            self.refreshed_at = time.time()
+        logger.info(f"Chat directory refreshed: {len(updated)} updated, {len(self.entries)} known")
+        return len(updated)
+
+    def ensure_loaded(self):
+        if self.refreshed_at is not None:
+            return
+        with self._refresh_lock:
+            # Concurrent first requests wait for one refresh instead of each running their own
+            if self.refreshed_at is None:
+                self._refresh()
+
+    def search(self, query=None, offset=0, limit=50):
+        """Entries matching query (case-insensitive, on topic or id), most recently active first.
+
+        Returns (total matches, entries in the requested page).
+        """
+        with self._lock:
+            entries = list(self.entries.values())
+        if query:
+            query = query.lower()
+            entries = [entry for entry in entries
+                       if query in (entry["topic"] or "").lower() or query in entry["id"].lower()]
+        entries.sort(key=lambda entry: (entry["topic"] or "").lower())
+        entries.sort(key=lambda entry: entry["last_activity"] or "", reverse=True)
+        return len(entries), entries[offset:offset + limit]
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Chat directory refresh failed: {e}")
+
+    def start_refresher(self):
+        with self._lock:
+            # A thread inherited across fork() is no longer alive
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(target=self._refresh_loop, name='ChatDirectoryRefresher', daemon=True)
+                self._refresher.start()
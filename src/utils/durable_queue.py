@@ -0,0 +1,236 @@
+# durable_queue.py
+import os
+import threading
+import time
+import uuid
+import logging
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection, add_column_if_missing
+from utils.send_scheduler import QueuedMessage, BUCKET_SWEEP_INTERVAL
+
+
+logger = logging.getLogger('DurableQueue')
+
+QUEUE_DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'message_queue.db')
+
+
+class SQLiteSendQueue:
+    """Send queue persisted in SQLite (WAL mode), shared by every process using the same file.
+
+    Messages are claimed with a visibility timeout: a claimed message is hidden
+    from other workers until it is acked, failed, or the timeout runs out (for
+    example because the worker died), after which it becomes claimable again.
+    Token buckets live in the same database, so the per-group rate limit holds
+    across all worker processes. Delivery is at-least-once: a worker that dies
+    after sending but before acking causes one resend after the timeout.
+
+    Every claim gets its own token in claimed_by. The sending worker renews it
+    every renew_interval seconds, and ack, fail and renew only touch rows still
+    holding that token, so a worker whose claim expired cannot release a claim
+    another worker took over.
+    """
+
+    def __init__(self, limits, path=QUEUE_DATABASE_PATH, visibility_timeout=60, max_attempts=5, retry_delay=30, poll_interval=0.5,
+                 coalesce=None):
+        self.limits = limits
+        self.coalesce = coalesce
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.renew_interval = visibility_timeout / 3
+        self._cond = threading.Condition()
+        self._swept_at = 0.0
+        self._init_db()
+
+    def _connection(self):
+        return get_sqlite_connection(self.path)
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS message_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                group_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_until REAL,
+                claimed_by TEXT,
+                dead INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                coalesce INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS idx_message_queue_group ON message_queue (dead, group_id, id);
+            CREATE TABLE IF NOT EXISTS group_buckets (
+                group_id TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''')
+        add_column_if_missing(conn, 'message_queue', 'coalesce', 'INTEGER NOT NULL DEFAULT 1')
+        logger.info("SQLite message queue initialized")
+
+    def put(self, group_id, message, coalesce=True):
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO message_queue (group_id, message, enqueued_at, available_at, coalesce) VALUES (?, ?, ?, ?, ?)',
+            (group_id, message, now, now, int(coalesce)))
+        with self._cond:
+            self._cond.notify()
+
+    def _take_token(self, conn, group_id, now):
+        """Consume a token for group_id inside the current transaction. Returns seconds to wait (0 on success)."""
+        rate, burst = self.limits(group_id)
+        burst = max(1, burst)
+        row = conn.execute('SELECT tokens, updated_at FROM group_buckets WHERE group_id = ?', (group_id,)).fetchone()
+        tokens = float(burst) if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate if rate > 0 else float('inf')
+        conn.execute('INSERT OR REPLACE INTO group_buckets (group_id, tokens, updated_at) VALUES (?, ?, ?)',
+                     (group_id, tokens - 1, now))
+        return 0.0
+
+    def _sweep_buckets(self, conn, now):
+        """Delete the buckets of groups with nothing queued once they have refilled; a fresh bucket is identical."""
+        self._swept_at = now
+        rows = conn.execute('''
+            SELECT b.group_id, b.tokens, b.updated_at FROM group_buckets b
+            WHERE NOT EXISTS (SELECT 1 FROM message_queue m WHERE m.dead = 0 AND m.group_id = b.group_id)
+        ''').fetchall()
+        idle = []
+        for group_id, tokens, updated_at in rows:
+            rate, burst = self.limits(group_id)
+            if tokens + max(0.0, now - updated_at) * rate >= max(1, burst):
+                idle.append((group_id,))
+        conn.executemany('DELETE FROM group_buckets WHERE group_id = ?', idle)
+
+    def _pending_run(self, conn, head, now):
+        """The head plus the messages queued behind it that are ready to be merged into the same post."""
+        rows = conn.execute('''
+            SELECT id, message, enqueued_at, available_at, attempts, coalesce FROM message_queue
+            WHERE dead = 0 AND group_id = ? AND id > ? ORDER BY id LIMIT 100
+        ''', (head.group_id, head.id)).fetchall()
+        items = [head]
+        for message_id, message, enqueued_at, available_at, attempts, coalesce in rows:
+            if available_at > now:
+                break
+            item = QueuedMessage(head.group_id, message, enqueued_at, coalesce=bool(coalesce))
+            item.id = message_id
+            item.attempts = attempts + 1
+            items.append(item)
+        return items
+
+    def _try_claim(self):
+        """Claim one message, or return (None, seconds until something may become claimable)."""
+        conn = self._connection()
+        now = time.time()
+        next_wait = self.poll_interval
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if now - self._swept_at > BUCKET_SWEEP_INTERVAL:
+                self._sweep_buckets(conn, now)
+            # Head of every group's FIFO, skipping groups that currently have a message in flight
+            heads = conn.execute('''
+                SELECT m.id, m.group_id, m.message, m.enqueued_at, m.available_at, m.attempts, m.coalesce
+                FROM message_queue m
+                WHERE m.dead = 0
+                  AND m.id = (SELECT MIN(h.id) FROM message_queue h WHERE h.dead = 0 AND h.group_id = m.group_id)
+                  AND (m.claimed_until IS NULL OR m.claimed_until <= ?)
+                ORDER BY m.id
+            ''', (now,)).fetchall()
+            for message_id, group_id, message, enqueued_at, available_at, attempts, coalesce in heads:
+                if available_at > now:
+                    next_wait = min(next_wait, available_at - now)
+                    continue
+                head = QueuedMessage(group_id, message, enqueued_at, coalesce=bool(coalesce))
+                head.id = message_id
+                head.attempts = attempts + 1
+                items = [head]
+                if self.coalesce and head.coalesce:
+                    pending = self._pending_run(conn, head, now)
+                    count = self.coalesce.take_run(pending)
+                    hold = self.coalesce.hold_for(pending, count, now)
+                    if hold:
+                        next_wait = min(next_wait, hold)
+                        continue
+                    items = pending[:count]
+                wait = self._take_token(conn, group_id, now)
+                if wait:
+                    next_wait = min(next_wait, wait)
+                    continue
+                token = uuid.uuid4().hex
+                conn.executemany('UPDATE message_queue SET claimed_until = ?, claimed_by = ?, attempts = attempts + 1 WHERE id = ?',
+                                 [(now + self.visibility_timeout, token, item.id) for item in items])
+                conn.execute('COMMIT')
+                claimed = self.coalesce.merge(items) if self.coalesce else head
+                claimed.claim = token
+                return claimed, 0.0
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return None, next_wait
+
+    def claim(self, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            item, wait = self._try_claim()
+            if item is not None:
+                return item
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Local puts wake us up early; other processes are picked up by polling
+            with self._cond:
+                self._cond.wait(min(wait, remaining))
+
+    def _claimed_rows(self, item, *values):
+        return [(*values, message_id, item.claim) for message_id in item.ids or [item.id]]
+
+    def _check_claim(self, item, cursor, action):
+        if cursor.rowcount < len(item.ids or [item.id]):
+            logger.warning(f"Claim on message {item.id} for group {item.group_id} expired before {action}; another worker owns it now")
+            return False
+        return True
+
+    def renew(self, item):
+        """Extend the claim on an item still being sent. Returns False if the claim was already lost."""
+        cursor = self._connection().executemany(
+            'UPDATE message_queue SET claimed_until = ? WHERE id = ? AND claimed_by = ?',
+            self._claimed_rows(item, time.time() + self.visibility_timeout))
+        return self._check_claim(item, cursor, 'renewing it')
+
+    def ack(self, item):
+        cursor = self._connection().executemany('DELETE FROM message_queue WHERE id = ? AND claimed_by = ?', self._claimed_rows(item))
+        self._check_claim(item, cursor, 'ack')
+
+    def fail(self, item, error=None):
+        """Make a failed message claimable again after a backoff, or park it once max_attempts is reached.
+
+        A coalesced post fails as a whole; its messages may be merged differently on the retry.
+        """
+        conn = self._connection()
+        ids = item.ids or [item.id]
+        if item.attempts >= self.max_attempts:
+            logger.error(f"Giving up on {len(ids)} message(s) from {item.id} for group {item.group_id} after {item.attempts} attempts")
+            cursor = conn.executemany('UPDATE message_queue SET dead = 1, claimed_until = NULL, last_error = ? WHERE id = ? AND claimed_by = ?',
+                                      self._claimed_rows(item, error))
+            self._check_claim(item, cursor, 'fail')
+            return
+        delay = self.retry_delay * (2 ** (item.attempts - 1))
+        available_at = time.time() + delay
+        cursor = conn.executemany('UPDATE message_queue SET claimed_until = NULL, available_at = ?, last_error = ? WHERE id = ? AND claimed_by = ?',
+                                  self._claimed_rows(item, available_at, error))
+        self._check_claim(item, cursor, 'fail')
+
+    def depth(self):
+        rows = self._connection().execute(
+            'SELECT group_id, COUNT(*) FROM message_queue WHERE dead = 0 GROUP BY group_id').fetchall()
+        return dict(rows)
+
+    def oldest(self):
+        rows = self._connection().execute(
+            'SELECT group_id, MIN(enqueued_at) FROM message_queue WHERE dead = 0 GROUP BY group_id').fetchall()
+        return dict(rows)
@@ -0,0 +1,78 @@
+# fake_mongodb.py
+"""In-memory stand-in for pymongo.MongoClient, for local runs and benchmarks without MongoDB.
+
+Needs mongomock (pip install mongomock), which is a development tool and not
+in requirements.txt. Install it on the connector before first use:
+
+    from utils.fake_mongodb import FakeMongoClient
+    mongodb_connector.client_factory = FakeMongoClient
+    mongodb_connector.enabled = True
+
+mongomock cannot run pymongo's bulk operation classes, so bulk_write replays
+the connector's Insert/Upsert operations one at a time through their public
+attributes, stopping at the first error when ordered like MongoDB does.
+"""
+import mongomock
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+from utils.mongodb_connector import Insert, Upsert
+
+
+class FakeCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        counts = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, Insert):
+                    self._collection.insert_one(request.document)
+                    counts["nInserted"] += 1
+                elif isinstance(request, Upsert):
+                    result = self._collection.update_one(request.filter, request.update, upsert=True)
+                    if result.upserted_id is not None:
+                        counts["nUpserted"] += 1
+                        counts["upserted"].append({"index": index, "_id": result.upserted_id})
+                    counts["nMatched"] += result.matched_count
+                    counts["nModified"] += result.modified_count
+                else:
+                    raise TypeError(f"FakeCollection cannot replay {type(request).__name__}; use Insert or Upsert")
+            except Exception as e:
+                errors.append({"index": index, "errmsg": str(e), "op": request})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError(dict(counts, writeErrors=errors, writeConcernErrors=[]))
+        return BulkWriteResult(counts, acknowledged=True)
+
+
+class FakeDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return FakeCollection(self._database[name])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+class FakeMongoClient:
+    """Accepts MongoClient's arguments and ignores the connection and pool options."""
+
+    def __init__(self, host=None, **options):
+        self._client = mongomock.MongoClient()
+        self.admin = self._client.admin
+
+    def __getitem__(self, name):
+        return FakeDatabase(self._client[name])
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,184 @@
+# fake_skype.py
+"""In-process stand-in for skpy.Skype, for exercising the session pool and senders without Skype.
+
+Only the parts of the skpy API this service uses are implemented:
+Skype(user, pwd, tokenFile), .conn.connected, .conn.syncStates, .chats.chat(id), .chats.recent(),
+chat.sendMsg(content), chat.getMsgs() and message .id/.time/.content.
+
+With reply_delay set, the fake also plays the AI bot: every prompt carrying an
+"id: <reply id>" line is answered in the same chat after that many seconds.
+"""
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from utils.send_scheduler import TokenBucket
+
+PROMPT_ID_PATTERN = re.compile(r'^id: ([\w-]+)$', re.MULTILINE)
+PROMPT_SESSION_PATTERN = re.compile(r'^session_id: (.*)$', re.MULTILINE)
+
+
+class FakeSkypeError(Exception):
+    pass
+
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, content, user_id='fake.user'):
+        self.id = str(next(self._ids))
+        self.time = datetime.utcnow()
+        self.content = content
+        self.userId = user_id
+
+
+class FakeChat:
+    # Messages returned by getMsgs(), newest first
+    page_size = 30
+
+    def __init__(self, skype, chat_id):
+        self.skype = skype
+        self.id = chat_id
+        self.topic = f"Fake chat {chat_id}"
+        self.messages = []
+        self.raw = {}
+        self._lock = threading.Lock()
+
+    def sendMsg(self, content):
+        self.skype.before_call()
+        message = self.receive(content, self.skype.user)
+        self.skype.sent.append((self.id, content))
+        self.skype.responder.answer(self, content)
+        return message
+
+    def receive(self, content, user_id):
+        """A message posted to the chat, by us or by someone else."""
+        message = FakeMessage(content, user_id)
+        with self._lock:
+            self.messages.append(message)
+            self.raw = {"lastMessage": {"composetime": message.time.isoformat()}}
+        return message
+
+    def getMsgs(self):
+        self.skype.before_call()
+        with self._lock:
+            return list(reversed(self.messages[-self.page_size:]))
+
+
+class FakeChats:
+    """Like skpy, recent() returns one page per call, each older than the last, following a sync state
+    in conn.syncStates; dropping that state starts over from the most recently active chats."""
+
+    page_size = 10
+
+    def __init__(self, skype):
+        self.skype = skype
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def chat(self, chat_id):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = FakeChat(self.skype, chat_id)
+            return chat
+
+    def recent(self):
+        self.skype.before_call()
+        conn = self.skype.conn
+        states = conn.syncStates.setdefault(("GET", f"{conn.msgsHost}/users/ME/conversations"), [])
+        offset = states[-1] if states else 0
+        with self._lock:
+            chats = sorted(self._chats.values(), key=lambda chat: (chat.raw.get("lastMessage") or {}).get("composetime") or "",
+                           reverse=True)
+        page = chats[offset:offset + self.page_size]
+        if page:
+            states.append(offset + len(page))
+        return {chat.id: chat for chat in page}
+
+
+class FakeResponder:
+    """Answers prompts like the AI bot would, from a single thread however many are pending."""
+
+    def __init__(self, skype):
+        self.skype = skype
+        self._due = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def answer(self, chat, content):
+        if self.skype.reply_delay is None:
+            return
+        match = PROMPT_ID_PATTERN.search(content)
+        if match is None:
+            return
+        session = PROMPT_SESSION_PATTERN.search(content)
+        reply = json.dumps({"message": "Fake reply", "message_type": "general",
+                            "session_id": session.group(1) if session else None, "reply_id": match.group(1)})
+        with self._condition:
+            heapq.heappush(self._due, (time.monotonic() + self.skype.reply_delay, next(self._order), chat, reply))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='FakeResponder', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, _, chat, reply = heapq.heappop(self._due)
+            chat.receive(reply, 'fake.bot')
+
+
+class FakeConnection:
+    msgsHost = 'https://fake.msgs.skype.com/v1'
+
+    def __init__(self):
+        self.connected = True
+        self.syncStates = {}
+
+
+class FakeSkype:
+    """Fake client with configurable call latency, failure rate, rate limit and bot reply delay."""
+
+    latency = 0.0
+    failure_rate = 0.0
+    # Calls per second before calls fail the way a throttled client does (0 = unlimited)
+    rate_limit = 0.0
+    # Seconds until the fake bot answers a prompt (None = never)
+    reply_delay = None
+
+    def __init__(self, user=None, pwd=None, tokenFile=None):
+        self.user = user or 'fake.user'
+        self.conn = FakeConnection()
+        self.chats = FakeChats(self)
+        self.sent = []
+        self.calls = 0
+        self.rate_limited = 0
+        self.responder = FakeResponder(self)
+        self._bucket = TokenBucket(self.rate_limit, self.rate_limit) if self.rate_limit else None
+        self._lock = threading.Lock()
+        if user and tokenFile:
+            with open(tokenFile, 'w') as file:
+                file.write(f"fake token for {user}\n")
+
+    def before_call(self):
+        with self._lock:
+            self.calls += 1
+            throttled = self._bucket is not None and self._bucket.wait_time() > 0
+            if throttled:
+                self.rate_limited += 1
+            elif self._bucket is not None:
+                self._bucket.consume()
+        if throttled:
+            raise FakeSkypeError("429 Too Many Requests")
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise FakeSkypeError("Simulated Skype failure")
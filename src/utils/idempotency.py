@@ -0,0 +1,85 @@
+# idempotency.py
+import os
+import hashlib
+import time
+import logging
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection
+
+
+logger = logging.getLogger('Idempotency')
+
+IDEMPOTENCY_DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'idempotency.db')
+
+# Seconds a retry is mapped onto the original request, and the most keys kept
+IDEMPOTENCY_WINDOW = float(os.getenv('IDEMPOTENCY_WINDOW', '300'))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '100000'))
+
+
+def idempotency_key(*parts):
+    """Stable digest of the parts; raw keys and messages are never stored."""
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """Maps idempotency keys to the job that first used them, in SQLite so every worker process sees it.
+
+    Keys expire after the window; expired keys are purged, and the oldest are
+    dropped once there are more than max_keys.
+    """
+
+    def __init__(self, path=IDEMPOTENCY_DATABASE_PATH, window=IDEMPOTENCY_WINDOW, max_keys=IDEMPOTENCY_MAX_KEYS):
+        self.path = path
+        self.window = window
+        self.max_keys = max_keys
+        self._last_purge = 0.0
+        self._connection().executescript('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+        ''')
+
+    def _connection(self):
+        return get_sqlite_connection(self.path)
+
+    def claim(self, key, job_id):
+        """Map key to job_id unless a live mapping exists. Returns the job id that owns the key."""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT job_id FROM idempotency_keys WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is None:
+                conn.execute('INSERT OR REPLACE INTO idempotency_keys (key, job_id, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                             (key, job_id, now, now + self.window))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            self.purge()
+        return job_id if row is None else row[0]
+
+    def replace(self, key, old_job_id, new_job_id):
+        """Hand the key over from a failed job to a new one; False if someone else already did."""
+        now = time.time()
+        cursor = self._connection().execute(
+            'UPDATE idempotency_keys SET job_id = ?, created_at = ?, expires_at = ? WHERE key = ? AND job_id = ?',
+            (new_job_id, now, now + self.window, key, old_job_id))
+        return cursor.rowcount == 1
+
+    def purge(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (time.time(),))
+        excess = conn.execute('SELECT COUNT(*) FROM idempotency_keys').fetchone()[0] - self.max_keys
+        if excess > 0:
+            conn.execute('DELETE FROM idempotency_keys WHERE key IN '
+                         '(SELECT key FROM idempotency_keys ORDER BY created_at LIMIT ?)', (excess,))
+            logger.info(f"Dropped {excess} idempotency keys over the limit of {self.max_keys}")
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,110 @@
+# job_store.py
+import os
+import json
+import hashlib
+import time
+import logging
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection, add_column_if_missing
+
+
+logger = logging.getLogger('JobStore')
+
+JOBS_DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'jobs.db')
+
+# Finished and expired jobs are purged after this many seconds
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', '86400'))
+
+PENDING = 'pending'
+COMPLETED = 'completed'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+JOB_COLUMNS = ('id', 'kind', 'status', 'result', 'error', 'callback_url', 'created_at', 'expires_at', 'completed_at', 'owner')
+
+
+def job_owner(api_key):
+    """Digest of the API key that created a job; only that key may read the job back."""
+    return hashlib.sha256(f"job-owner\0{api_key}".encode('utf-8')).hexdigest()
+
+
+class JobStore:
+    """Job state kept in SQLite (WAL mode), so any worker process can report on any job."""
+
+    def __init__(self, path=JOBS_DATABASE_PATH, retention=JOB_RETENTION):
+        self.path = path
+        self.retention = retention
+        self._last_purge = 0.0
+        conn = self._connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                callback_url TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                completed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at);
+        ''')
+        add_column_if_missing(conn, 'jobs', 'owner', 'TEXT')
+
+    def _connection(self):
+        return get_sqlite_connection(self.path)
+
+    def create(self, job_id, kind, timeout, callback_url=None, owner=None):
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO jobs (id, kind, status, callback_url, created_at, expires_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, PENDING, callback_url, now, now + timeout, owner))
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            self.purge()
+        return job_id
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self._connection().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, completed_at = ? WHERE id = ? AND status = ?',
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, PENDING))
+
+    def complete(self, job_id, result):
+        self._finish(job_id, COMPLETED, result=result)
+
+    def fail(self, job_id, error, status=FAILED):
+        self._finish(job_id, status, error=error)
+
+    def get(self, job_id, owner=None):
+        """The job, or None if it does not exist or, when owner is given, belongs to someone else."""
+        row = self._connection().execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        if owner is not None and job['owner'] != owner:
+            return None
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        # The worker owning a job may have died; never report it as pending forever
+        if job['status'] == PENDING and time.time() > job['expires_at'] + 30:
+            job['status'] = TIMEOUT
+            job['error'] = "Timeout. Try again or contact administrator"
+        return job
+
+    def wait(self, job_id, timeout, poll_interval=0.5, owner=None):
+        """Long-poll: return the job once it is no longer pending, or as it is after timeout seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, owner)
+            if job is None or job['status'] != PENDING or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def delete(self, job_id):
+        self._connection().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def purge(self):
+        cutoff = time.time() - self.retention
+        self._connection().execute('DELETE FROM jobs WHERE created_at < ?', (cutoff,))
+
+
+job_store = JobStore()
@@ -1,29 +1,29 @@
-from skpy import Skype
+# Run from src/ as: python -m utils.list_groups
 import os
 from dotenv import load_dotenv
+from utils.skype_session import SkypeSession
+from utils.skype_pool import SKYPE_SESSION_DIR, LEGACY_SESSION_FILE, session_file_for
+from utils.chat_directory import ChatDirectory
+from utils.logging_setup import setup_logging
 
 load_dotenv()
 
-def list_recent_chats(username, password):
-    sk = Skype(username, password)  # Connect to Skype
-
-    chats = []
-    for chat_id in sk.chats.recent():
-        chat = sk.chats.chat(chat_id)  # Fetch the chat object
-        chat_info = {
-            "name": chat.topic if hasattr(chat, 'topic') else "Individual Chat",
-            "id": chat_id
-        }
-        chats.append(chat_info)
-    
-    return chats
+def list_recent_chats(username, password, session_file):
+    # Reuses the service's session file, so this only logs in when the token is missing or old
+    directory = ChatDirectory(SkypeSession(username, password, session_file))
+    directory.refresh()
+    _, entries = directory.search(limit=len(directory.entries))
+    return [{"name": entry["topic"], "id": entry["id"]} for entry in entries]
 
 if __name__ == "__main__":
+    setup_logging()
     skype_username = os.getenv("SKYPE_USERNAME")
     skype_password = os.getenv("SKYPE_PASSWORD")
 
     if skype_username and skype_password:
-        recent_chats = list_recent_chats(skype_username, skype_password)
+        # Same file the service uses for this account
+        session_file = session_file_for(skype_username) if os.getenv('SKYPE_ACCOUNTS') else os.path.join(SKYPE_SESSION_DIR, LEGACY_SESSION_FILE)
+        recent_chats = list_recent_chats(skype_username, skype_password, session_file)
         for chat in recent_chats:
             print(f"Name: {chat['name']}, ID: {chat['id']}")
     else:
@@ -0,0 +1,197 @@
+# logging_setup.py
+"""Process-wide logging. Modules only call logging.getLogger(name); setup_logging() wires the root logger.
+
+Request threads put records on a bounded queue and return; a QueueListener
+thread formats, redacts, truncates and writes them. When the queue is full
+records are dropped rather than blocking the caller, and each call site may
+emit at most LOG_RATE_LIMIT records per second below ERROR, so log volume
+stays flat under load.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from utils.send_scheduler import TokenBucket
+from utils.metrics import registry
+
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'text' (the classic one-line format) or 'json' (one object per line)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', '1000'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', '20'))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+SECRET_PATTERN = re.compile(r'(?i)\b(password|passwd|pwd|secret|token|api[_-]?key)(["\']?\s*[:=]\s*["\']?)[^\s"\',;&}]+')
+URI_CREDENTIALS_PATTERN = re.compile(r'(\w+://)[^/\s:@]+:[^/\s@]+@')
+# Settings whose values never appear in a log line
+SECRET_SETTINGS = ('SKYPE_PASSWORD', 'MONGODB_PASSWORD', 'MONGODB_URI')
+
+# Attributes every LogRecord has; anything else was passed with extra= and is output as a field
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+dropped_records = registry.counter('log_records_dropped_total', 'Log records not written, by reason', ('reason',))
+
+
+def secret_values():
+    return [value for value in (os.getenv(name) for name in SECRET_SETTINGS) if value and len(value) >= 4]
+
+
+def redact(text, secrets=()):
+    for secret in secrets:
+        text = text.replace(secret, '***')
+    text = SECRET_PATTERN.sub(r'\1\2***', text)
+    return URI_CREDENTIALS_PATTERN.sub(r'\1***@', text)
+
+
+def truncate(text, limit=LOG_MAX_LENGTH):
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... ({len(text) - limit} more chars)"
+    return text
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, fmt=TEXT_FORMAT, max_length=LOG_MAX_LENGTH):
+        super().__init__(fmt)
+        self.max_length = max_length
+        self.secrets = secret_values()
+
+    def formatMessage(self, record):
+        record.message = truncate(redact(record.message, self.secrets), self.max_length)
+        if getattr(record, 'suppressed', 0):
+            record.message += f" ({record.suppressed} similar suppressed)"
+        return super().formatMessage(record)
+
+    def formatException(self, exc_info):
+        return redact(super().formatException(exc_info), self.secrets)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with extra= are included, strings truncated."""
+
+    def __init__(self, max_length=LOG_MAX_LENGTH):
+        super().__init__()
+        self.max_length = max_length
+        self.secrets = secret_values()
+
+    def _clean(self, value):
+        return truncate(redact(value, self.secrets), self.max_length)
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": self._clean(record.getMessage()),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES and key not in entry:
+                entry[key] = self._clean(value) if isinstance(value, str) else value
+        if record.exc_info:
+            entry["exception"] = redact(self.formatException(record.exc_info), self.secrets)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """At most `rate` records per second from each call site; errors always pass.
+
+    How many records were suppressed is attached to the next one let through.
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self._buckets = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.ERROR:
+            return True
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(site)
+            if bucket is None:
+                bucket = self._buckets[site] = TokenBucket(self.rate, self.rate)
+            if bucket.wait_time() > 0:
+                self._suppressed[site] = self._suppressed.get(site, 0) + 1
+                dropped_records.inc(reason='rate_limited')
+                return False
+            bucket.consume()
+            suppressed = self._suppressed.pop(site, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without formatting them or waiting for queue space."""
+
+    def prepare(self, record):
+        # The listener lives in this process, so the record needs no pickling;
+        # message arguments are merged and formatted on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc(reason='queue_full')
+
+
+_listener = None
+_pid = None
+_lock = threading.Lock()
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Route all logging through this process's queue and listener thread.
+
+    Cheap to call repeatedly. A process forked after setup has the handler
+    but not the listener thread, so calling it again there starts a new pair.
+    """
+    global _listener, _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        if log_format not in ('text', 'json'):
+            raise ValueError(f"LOG_FORMAT must be text or json, not {log_format!r}")
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+        handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        handler.addFilter(RateLimitFilter())
+
+        root = logging.getLogger()
+        for inherited in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+            root.removeHandler(inherited)
+        root.addHandler(handler)
+        root.setLevel(level)
+
+        listener = logging.handlers.QueueListener(handler.queue, output)
+        listener.start()
+        if _listener is None:
+            atexit.register(flush_logging)
+        _listener, _pid = listener, os.getpid()
+
+
+def flush_logging():
+    """Write out queued records and stop the listener; runs at exit."""
+    global _pid
+    with _lock:
+        listener = _listener if _pid == os.getpid() else None
+        _pid = None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,382 @@
+# metrics.py
+"""Counters, gauges and histograms, rendered in the Prometheus text exposition format.
+
+Recording is a dict update under a per-metric lock, cheap enough to stay on in
+production. With METRICS_MULTIPROCESS (the default), every process adds what
+it recorded to db/metrics.db every METRICS_FLUSH_INTERVAL seconds and on each
+scrape, so whichever gunicorn worker answers /metrics reports the totals of
+all of them.
+"""
+import atexit
+import bisect
+import json
+import math
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+import logging
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection
+
+
+logger = logging.getLogger('Metrics')
+
+METRICS_MULTIPROCESS = os.getenv('METRICS_MULTIPROCESS', 'true').lower() == 'true'
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'metrics.db')
+
+# Seconds; spans a cached lookup up to a reply that takes minutes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    kind = None
+
+    # How values from several processes combine: 'add' (each flush adds its increments),
+    # 'sum', 'max' or 'min' (over the latest value of every live process) or None (this process only)
+    aggregate = 'add'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def snapshot(self):
+        """{label values: value} recorded by this process."""
+        with self._lock:
+            return dict(self._values)
+
+    def take_pending(self):
+        """[(label values, field, increment)] recorded since the last call."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(key, '', amount) for key, amount in pending.items()]
+
+    def drop_pending(self):
+        with self._lock:
+            self._pending = {}
+
+    def from_fields(self, fields):
+        """Values in snapshot() form from the stored {(label values, field): value}."""
+        return {key: value for (key, field), value in fields.items()}
+
+    def samples(self, values):
+        """(suffix, label values, extra labels, value) for every series."""
+        return [('', key, (), value) for key, value in values.items()]
+
+    def render(self, values=None):
+        values = self.snapshot() if values is None else values
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples(values):
+            lines.append(f'{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Set directly, or computed at scrape time by func (a number, or {label values tuple: number}).
+
+    aggregate says how to combine processes: None for values every process
+    reads from shared storage anyway, otherwise 'sum', 'max' or 'min'.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), func=None, aggregate='sum'):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+        self.aggregate = aggregate
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def snapshot(self):
+        if self.func is None:
+            return super().snapshot()
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.error(f"Failed to collect {self.name}: {e}")
+            return {}
+        if not isinstance(values, dict):
+            values = {(): values}
+        return {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+
+    def take_pending(self):
+        return [(key, '', value) for key, value in self.snapshot().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            for values in (self._values, self._pending):
+                series = values.get(key)
+                if series is None:
+                    # Per-bucket counts (not cumulative) plus the +Inf bucket, then sum
+                    series = values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                series[0][index] += 1
+                series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return sum(series[0]) if series else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    def take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(key, field, amount) for key, (counts, total) in pending.items()
+                for field, amount in [*((str(index), count) for index, count in enumerate(counts) if count), ('sum', total)]]
+
+    def from_fields(self, fields):
+        values = {}
+        for (key, field), amount in fields.items():
+            series = values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            if field == 'sum':
+                series[1] = amount
+            else:
+                series[0][int(field)] = int(amount)
+        return values
+
+    def samples(self, values):
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class SharedMetricsStore:
+    """Metric values of every process using the same SQLite file.
+
+    Counters and histograms live in one row per series and field, to which each
+    process adds its increments. Aggregated gauges keep one row per process,
+    ignored once the process has not flushed for stale_after seconds.
+    """
+
+    def __init__(self, path=METRICS_DATABASE_PATH, stale_after=3 * METRICS_FLUSH_INTERVAL):
+        self.path = path
+        self.stale_after = stale_after
+        self.process = f"{socket.gethostname()}:{os.getpid()}"
+        self._pid = None
+
+    def _connection(self):
+        conn = get_sqlite_connection(self.path)
+        # Opened lazily: importing the app must not touch the disk
+        if self._pid != os.getpid():
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS metric_totals (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, labels, field)
+                );
+                CREATE TABLE IF NOT EXISTS metric_gauges (
+                    process TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (process, name, labels)
+                );
+            ''')
+            self.process = f"{socket.gethostname()}:{os.getpid()}"
+            self._pid = os.getpid()
+        return conn
+
+    def write(self, totals, gauges):
+        """Add totals [(name, label values, field, increment)] and replace this process's gauges [(name, label values, value)]."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                INSERT INTO metric_totals (name, labels, field, value) VALUES (?, ?, ?, ?)
+                ON CONFLICT (name, labels, field) DO UPDATE SET value = value + excluded.value
+            ''', [(name, json.dumps(key), field, amount) for name, key, field, amount in totals])
+            conn.execute('DELETE FROM metric_gauges WHERE process = ? OR updated_at < ?', (self.process, now - self.stale_after))
+            conn.executemany('INSERT INTO metric_gauges (process, name, labels, value, updated_at) VALUES (?, ?, ?, ?, ?)',
+                             [(self.process, name, json.dumps(key), value, now) for name, key, value in gauges])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def forget_gauges(self):
+        """Drop this process's gauges, at exit, instead of leaving them until they go stale."""
+        self._connection().execute('DELETE FROM metric_gauges WHERE process = ?', (self.process,))
+
+    def read(self):
+        """({name: {(label values, field): total}}, {name: {label values: [value per live process]}})."""
+        conn = self._connection()
+        totals, gauges = {}, {}
+        for name, labels, field, value in conn.execute('SELECT name, labels, field, value FROM metric_totals'):
+            totals.setdefault(name, {})[(tuple(json.loads(labels)), field)] = value
+        rows = conn.execute('SELECT name, labels, value FROM metric_gauges WHERE updated_at >= ?', (time.time() - self.stale_after,))
+        for name, labels, value in rows:
+            gauges.setdefault(name, {}).setdefault(tuple(json.loads(labels)), []).append(value)
+        return totals, gauges
+
+
+GAUGE_AGGREGATES = {'sum': sum, 'max': max, 'min': min}
+
+
+class MetricsRegistry:
+    def __init__(self, store=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), func=None, aggregate='sum'):
+        return self._get_or_create(Gauge, name, help_text, labelnames, func=func, aggregate=aggregate)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def _all(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def flush(self):
+        """Add this process's increments since the last flush, and its current gauges, to the shared store."""
+        if self.store is None:
+            return
+        with self._flush_lock:
+            totals, gauges = [], []
+            for metric in self._all():
+                if metric.aggregate == 'add':
+                    totals.extend((metric.name, key, field, amount) for key, field, amount in metric.take_pending())
+                elif metric.aggregate is not None:
+                    gauges.extend((metric.name, key, value) for key, _, value in metric.take_pending())
+            try:
+                self.store.write(totals, gauges)
+            except Exception as e:
+                logger.error(f"Failed to flush metrics, dropping {len(totals)} increments: {e}")
+
+    def _shutdown(self):
+        self.flush()
+        try:
+            self.store.forget_gauges()
+        except Exception as e:
+            logger.error(f"Failed to remove this process's gauges: {e}")
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start_flusher(self):
+        """Start this process's periodic flush; call after fork. Cheap no-op when already running."""
+        if self.store is None or self._flusher_pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            if self._flusher_pid is None:
+                atexit.register(self._shutdown)
+            # Increments recorded before fork belong to the parent
+            for metric in self._all():
+                metric.drop_pending()
+            threading.Thread(target=self._flush_loop, name='MetricsFlusher', daemon=True).start()
+            self._flusher_pid = os.getpid()
+
+    def render(self):
+        metrics = self._all()
+        totals = gauges = None
+        if self.store is not None:
+            self.flush()
+            try:
+                totals, gauges = self.store.read()
+            except Exception as e:
+                logger.error(f"Failed to read shared metrics, reporting this process only: {e}")
+        lines = []
+        for metric in metrics:
+            values = None
+            if totals is not None and metric.aggregate == 'add':
+                values = metric.from_fields(totals.get(metric.name, {}))
+            elif totals is not None and metric.aggregate is not None:
+                combine = GAUGE_AGGREGATES[metric.aggregate]
+                values = {key: combine(process_values) for key, process_values in gauges.get(metric.name, {}).items()}
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry(SharedMetricsStore() if METRICS_MULTIPROCESS else None)
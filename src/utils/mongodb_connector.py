@@ -1,28 +1,136 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING, monitoring
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import logging
+from utils.metrics import registry
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('MongoDBConnector')
 
+# Connection pool tuning, see the pymongo MongoClient documentation for the semantics
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50'))
+MONGODB_MIN_POOL_SIZE = int(os.getenv('MONGODB_MIN_POOL_SIZE', '0'))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000'))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000'))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+
+# (collection, keys, options) created at startup if missing
+REQUIRED_INDEXES = [
+    ("api_keys", [("key", ASCENDING)], {"unique": True}),
+    ("messages", [("message_id", ASCENDING)], {}),
+    ("messages", [("session_id", ASCENDING), ("timestamp", ASCENDING)], {}),
+]
+
+write_latency = registry.histogram('mongodb_write_seconds', 'MongoDB write latency by operation and result', ('operation', 'result'))
+documents_written = registry.counter('mongodb_write_operations_total', 'Documents inserted or updated by collection', ('collection',))
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so pool utilization can be reported."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.check_out_failures = 0
+
+    def _add(self, field, delta):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def connection_created(self, event):
+        self._add('open', 1)
+
+    def connection_closed(self, event):
+        self._add('open', -1)
+
+    def connection_checked_out(self, event):
+        self._add('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        self._add('checked_out', -1)
+
+    def connection_check_out_failed(self, event):
+        self._add('check_out_failures', 1)
+
+    # pymongo requires every event handler to be implemented
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+class Insert(InsertOne):
+    """InsertOne whose document stays readable, so a stand-in client can replay a batch."""
+
+    def __init__(self, document):
+        super().__init__(document)
+        self.document = document
+
+
+class Upsert(UpdateOne):
+    """UpdateOne(filter, update, upsert=True) whose arguments stay readable, like Insert."""
+
+    def __init__(self, filter, update):
+        super().__init__(filter, update, upsert=True)
+        self.filter = filter
+        self.update = update
+
+
 class MongoDBConnector:
 
+    # Called like pymongo.MongoClient; utils.fake_mongodb swaps in an in-memory client for local runs
+    client_factory = MongoClient
+
     def __init__(self):
         self.client = None
         self.db = None
+        self.pool_listener = PoolStatsListener()
+        self._pid = None
+        self._connect_lock = threading.Lock()
         self.enabled = os.getenv('ENABLE_MONGODB', 'false').lower() == 'true'
         if self.enabled:
             logger.info("MongoDBConnector initialized and MongoDB is enabled")
         else:
             logger.info("MongoDBConnector initialized but MongoDB is disabled")
 
+    def ensure_connected(self):
+        """Connect on first use in this process and return the database (None when disabled).
+
+        A MongoClient must not be shared across fork(), so a process that
+        inherited one from its parent opens its own.
+        """
+        if self.enabled and self._pid != os.getpid():
+            with self._connect_lock:
+                if self._pid != os.getpid():
+                    self.connect()
+        return self.db
+
     def connect(self):
         if not self.enabled:
             logger.info("MongoDB connection skipped because it is disabled")
             return
+        self._pid = os.getpid()
+        self.client = None
+        self.db = None
+        self.pool_listener = PoolStatsListener()
         db_name = os.getenv('MONGODB_DB_NAME')
         host = os.getenv('MONGODB_URI')
         user = os.getenv('MONGODB_USER', '').strip()
@@ -34,27 +142,88 @@ class MongoDBConnector:
             mongo_uri = f"mongodb://{host}/{db_name}"
 
         try:
-            self.client = MongoClient(mongo_uri)
+            self.client = self.client_factory(
+                mongo_uri,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+                waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                event_listeners=[self.pool_listener],
+            )
             self.db = self.client[db_name]
             logger.info("Successfully connected to MongoDB")
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
+            return
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """Create the indexes lookups rely on; existing indexes are left alone."""
+        for collection_name, keys, options in REQUIRED_INDEXES:
+            try:
+                self.db[collection_name].create_index(keys, background=True, **options)
+            except Exception as e:
+                logger.error(f"Failed to create index {keys} on {collection_name}: {e}")
+        logger.info("MongoDB indexes ensured")
+
+    def ping(self):
+        self.ensure_connected()
+        if self.client is None:
+            return False
+        try:
+            self.client.admin.command('ping')
+            return True
+        except Exception as e:
+            logger.error(f"MongoDB ping failed: {e}")
+            return False
+
+    def pool_stats(self):
+        listener = self.pool_listener
+        with listener.lock:
+            return {
+                "max_pool_size": MONGODB_MAX_POOL_SIZE,
+                "open": listener.open,
+                "checked_out": listener.checked_out,
+                "check_out_failures": listener.check_out_failures,
+                "utilization": round(listener.checked_out / MONGODB_MAX_POOL_SIZE, 3) if MONGODB_MAX_POOL_SIZE else 0.0,
+            }
 
     def insert_message(self, collection_name, document):
-        if self.db is None:
+        if self.ensure_connected() is None:
             logger.warning("Attempted to insert message without a MongoDB connection")
             return False
+        start = time.perf_counter()
         try:
             collection = self.db[collection_name]
             collection.insert_one(document)
-            logger.info(f"Successfully inserted document into {collection_name}")
+            write_latency.observe(time.perf_counter() - start, operation='insert_one', result='ok')
+            documents_written.inc(collection=collection_name)
+            logger.info("Successfully inserted document into %s", collection_name)
             return True
         except Exception as e:
+            write_latency.observe(time.perf_counter() - start, operation='insert_one', result='error')
             logger.error(f"Failed to insert document: {e}")
             return False
-    
-# Create the MongoDBConnector instance
-mongodb_connector = MongoDBConnector()
-if mongodb_connector.enabled:
-    mongodb_connector.connect()
-    logger.info("Using MongoDB")
\ No newline at end of file
+
+    def bulk_write(self, collection_name, operations, ordered=True):
+        """Write a batch of Insert/Upsert operations in one round trip."""
+        if self.ensure_connected() is None:
+            logger.warning("Attempted to write documents without a MongoDB connection")
+            return False
+        start = time.perf_counter()
+        try:
+            result = self.db[collection_name].bulk_write(operations, ordered=ordered)
+            logger.info("Bulk wrote %d operations into %s (%d inserted, %d upserted, %d modified)", len(operations),
+                        collection_name, result.inserted_count, result.upserted_count, result.modified_count)
+            write_latency.observe(time.perf_counter() - start, operation='bulk_write', result='ok')
+            documents_written.inc(len(operations), collection=collection_name)
+            return True
+        except Exception as e:
+            write_latency.observe(time.perf_counter() - start, operation='bulk_write', result='error')
+            logger.error(f"Failed to bulk write documents: {e}")
+            return False
+
+# Create the MongoDBConnector instance; it connects on first use, in the process that uses it
+mongodb_connector = MongoDBConnector()
\ No newline at end of file
@@ -0,0 +1,94 @@
+# prompt_priming.py
+import os
+import hashlib
+import time
+import logging
+from functools import lru_cache
+from utils.storage import SQLITE_DB_DIR, get_sqlite_connection
+
+
+logger = logging.getLogger('PromptPriming')
+
+PRIMING_DATABASE_PATH = os.path.join(SQLITE_DB_DIR, 'prompt_priming.db')
+
+# 'off' sends the prompt with every message. 'session' sends it with the first
+# message of each session_id, 'version' once per prompt version for the whole
+# group; later messages carry only the prompt_version line. The prompt is
+# sent again after PROMPT_PRIMING_TTL seconds, or as soon as it changes.
+PROMPT_PRIMING = os.getenv('PROMPT_PRIMING', 'off').lower()
+PROMPT_PRIMING_TTL = float(os.getenv('PROMPT_PRIMING_TTL', '3600'))
+
+OFF = 'off'
+SESSION = 'session'
+VERSION = 'version'
+
+
+@lru_cache(maxsize=32)
+def prompt_version(prefix):
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:12]
+
+
+class PrimingStore:
+    """Which scopes (sessions, or whole profiles) have already been sent which prompt version.
+
+    Kept in SQLite, so every worker process agrees on whether a session still
+    needs the full prompt.
+    """
+
+    def __init__(self, mode=PROMPT_PRIMING, ttl=PROMPT_PRIMING_TTL, path=PRIMING_DATABASE_PATH):
+        if mode not in (OFF, SESSION, VERSION):
+            raise ValueError(f"PROMPT_PRIMING must be one of off, session or version, not {mode!r}")
+        self.mode = mode
+        self.ttl = ttl
+        self.path = path
+        self._last_purge = 0.0
+        if self.enabled:
+            self._connection().executescript('''
+                CREATE TABLE IF NOT EXISTS primed_scopes (
+                    scope TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    primed_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_primed_scopes_expires_at ON primed_scopes (expires_at);
+            ''')
+
+    @property
+    def enabled(self):
+        return self.mode != OFF
+
+    def _connection(self):
+        return get_sqlite_connection(self.path)
+
+    def scope_for(self, session_id, profile):
+        if self.mode == SESSION:
+            return f"session:{profile}:{session_id}"
+        return f"profile:{profile}"
+
+    def claim(self, scope, version):
+        """True if the caller must send the full prompt; the scope then counts as primed with version."""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT 1 FROM primed_scopes WHERE scope = ? AND version = ? AND expires_at > ?',
+                               (scope, version, now)).fetchone()
+            if row is None:
+                conn.execute('INSERT OR REPLACE INTO primed_scopes (scope, version, primed_at, expires_at) VALUES (?, ?, ?, ?)',
+                             (scope, version, now, now + self.ttl))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            conn.execute('DELETE FROM primed_scopes WHERE expires_at <= ?', (now,))
+        return row is None
+
+    def forget(self, scope, version):
+        """The priming message went unanswered, so the next message must carry the prompt again."""
+        self._connection().execute('DELETE FROM primed_scopes WHERE scope = ? AND version = ?', (scope, version))
+        logger.info("Priming of %s forgotten", scope)
+
+
+priming_store = PrimingStore()
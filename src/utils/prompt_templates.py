@@ -0,0 +1,95 @@
+# prompt_templates.py
+import os
+import re
+import signal
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger('PromptTemplates')
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PROFILE = 'default'
+PROFILE_NAME_PATTERN = re.compile(r'[\w-]+')
+
+
+class UnknownProfileError(KeyError):
+    pass
+
+
+class PromptTemplateStore:
+    """Caches the prompt/instructions prefix per profile and reloads it when the files change.
+
+    The 'default' profile is prompt.txt and instructions.txt next to app.py.
+    Other profiles live in prompts/<name>/prompt.txt and prompts/<name>/instructions.txt.
+    Files are stat'ed at most once every check_interval seconds.
+    """
+
+    def __init__(self, base_dir=BASE_DIR, check_interval=1.0):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, profile):
+        if profile == DEFAULT_PROFILE:
+            directory = self.base_dir
+        elif PROFILE_NAME_PATTERN.fullmatch(profile):
+            directory = os.path.join(self.base_dir, 'prompts', profile)
+        else:
+            raise UnknownProfileError(profile)
+        return os.path.join(directory, 'prompt.txt'), os.path.join(directory, 'instructions.txt')
+
+    @staticmethod
+    def _mtimes(paths):
+        return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+    def _load(self, profile, paths, mtimes):
+        if all(mtime is None for mtime in mtimes):
+            raise UnknownProfileError(profile)
+        parts = []
+        for path, mtime in zip(paths, mtimes):
+            if mtime is None:
+                parts.append('')
+                continue
+            with open(path, 'r') as file:
+                parts.append(file.read().strip())
+        prompt, instructions = parts
+        logger.info(f"Loaded prompt profile '{profile}'")
+        return {"prefix": f"{prompt}\n{instructions}\n", "mtimes": mtimes, "checked_at": time.monotonic()}
+
+    def prefix(self, profile=DEFAULT_PROFILE):
+        """Return 'prompt\\ninstructions\\n' for profile, reloading it if its files changed."""
+        # profile comes straight from the request body, so it may be a number or a list
+        if not isinstance(profile, str):
+            raise UnknownProfileError(profile)
+        entry = self._profiles.get(profile)
+        now = time.monotonic()
+        if entry is not None and now - entry["checked_at"] < self.check_interval:
+            return entry["prefix"]
+        with self._lock:
+            paths = self._paths(profile)
+            mtimes = self._mtimes(paths)
+            entry = self._profiles.get(profile)
+            if entry is None or entry["mtimes"] != mtimes:
+                entry = self._load(profile, paths, mtimes)
+                self._profiles[profile] = entry
+            else:
+                entry["checked_at"] = now
+            return entry["prefix"]
+
+    def reload(self):
+        with self._lock:
+            self._profiles.clear()
+        logger.info("Prompt templates reloaded")
+
+    def install_sighup_handler(self):
+        """Reload all profiles on SIGHUP. Only possible from the main thread."""
+        if not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+
+
+prompt_templates = PromptTemplateStore()
@@ -0,0 +1,187 @@
+# reply_dispatcher.py
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+import logging
+import pytz
+from utils.ttl_cache import TTLCache
+from utils.metrics import registry
+
+
+logger = logging.getLogger('ReplyDispatcher')
+
+# Messages this much older than the watermark are treated as history and never parsed
+WATERMARK_SKEW = 5.0
+
+# Covers sync and async requests alike, from registration until the reply arrives or the wait expires
+reply_wait = registry.histogram('skype_reply_wait_seconds', 'Time from registering for an AI reply until it arrives or expires', ('result',))
+poll_latency = registry.histogram('skype_reply_poll_seconds', 'Latency of one getMsgs() poll by a reply dispatcher')
+
+
+def resolve(future, result=None, exception=None):
+    """Settle a waiter's future unless its owner cancelled it first; False if it was cancelled.
+
+    Done callbacks run right here on the poller thread, so they must only hand work off, never block.
+    """
+    if future.cancelled():
+        return False
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        # Cancelled between the check and the call
+        return False
+    return True
+
+
+class ReplyDispatcher:
+    """Polls a single Skype chat on behalf of every waiting request.
+
+    Each incoming message is parsed once and handed to the futures registered
+    for its ``reply_id``. The poller thread only runs while someone is waiting,
+    so upstream load is one ``getMsgs()`` call per interval per chat no matter
+    how many requests are pending.
+
+    A watermark (newest message time seen) and a bounded set of seen message
+    ids make sure a message is parsed only once, even though ``getMsgs()``
+    keeps returning it. Parsed replies are kept for ``result_ttl`` seconds so
+    a waiter registering after its reply arrived still gets it.
+    """
+
+    def __init__(self, group_id, get_chat, parse_message, poll_interval=1.0, seen_size=2048, result_ttl=120):
+        self.group_id = group_id
+        self.get_chat = get_chat
+        self.parse_message = parse_message
+        self.poll_interval = poll_interval
+        self.seen_size = seen_size
+        self.parsed_count = 0
+        self.skipped_count = 0
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._chat = None
+        self._watermark = None
+        self._seen = OrderedDict()
+        self._results = TTLCache(maxsize=1024, ttl=result_ttl)
+
+    def register(self, reply_id, timeout=120):
+        """Return a future resolved with the parsed reply for reply_id, or TimeoutError after timeout seconds."""
+        future = Future()
+        started_at = time.time()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            reply = self._results.get(reply_id)
+            if reply is not None:
+                future.set_result(reply)
+                return future
+            self._waiters.setdefault(reply_id, []).append((future, started_at, deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"ReplyDispatcher-{self.group_id}", daemon=True)
+                self._thread.start()
+        return future
+
+    def cancel(self, reply_id, future=None):
+        """Stop waiting for reply_id, either for one future or for all of them."""
+        with self._lock:
+            waiters = self._waiters.get(reply_id, [])
+            cancelled = [waiter for waiter in waiters if future is None or waiter[0] is future]
+            remaining = [waiter for waiter in waiters if waiter not in cancelled]
+            if remaining:
+                self._waiters[reply_id] = remaining
+            else:
+                self._waiters.pop(reply_id, None)
+        for waiter in cancelled:
+            waiter[0].cancel()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _expire_waiters(self):
+        """Drop waiters past their deadline and return the oldest start time still waiting, or None."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for reply_id, waiters in list(self._waiters.items()):
+                # Futures cancelled by their owner are dropped, so they cannot keep the poller running
+                remaining = [waiter for waiter in waiters if waiter[2] > now and not waiter[0].cancelled()]
+                expired.extend(waiter for waiter in waiters if waiter[2] <= now and not waiter[0].cancelled())
+                if remaining:
+                    self._waiters[reply_id] = remaining
+                else:
+                    del self._waiters[reply_id]
+            if not self._waiters:
+                # Start from the next waiter's start time when polling resumes
+                self._thread = None
+                self._watermark = None
+                oldest = None
+            else:
+                oldest = min(waiter[1] for waiters in self._waiters.values() for waiter in waiters)
+        for future, started_at, _ in expired:
+            if resolve(future, exception=TimeoutError("Timeout reached without finding a matching message.")):
+                reply_wait.observe(time.time() - started_at, result='timeout')
+        return oldest
+
+    def _mark_seen(self, message_id):
+        self._seen[message_id] = None
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+
+    def _poll(self, oldest):
+        if self._chat is None:
+            self._chat = self.get_chat()
+            if self._chat is None:
+                logger.error("Failed to get chat for reply dispatcher.")
+                return
+        try:
+            with poll_latency.time():
+                messages = self._chat.getMsgs()
+        except Exception as e:
+            logger.error("Error fetching messages for reply dispatcher: %s", e)
+            self._chat = None
+            return
+
+        if self._watermark is None:
+            self._watermark = oldest
+        newest = self._watermark
+        for message in messages:
+            if message.id in self._seen:
+                self.skipped_count += 1
+                continue
+            message_time = message.time.replace(tzinfo=pytz.utc).timestamp()
+            if message_time < self._watermark - WATERMARK_SKEW:
+                self.skipped_count += 1
+                continue
+            self._mark_seen(message.id)
+            newest = max(newest, message_time)
+            self.parsed_count += 1
+            # Lazy, truncated and rate limited by the logging setup, so cheap to leave in
+            logger.debug("Checking message %s: %s", message.id, message.content)
+            parsed_message = self.parse_message(message.content)
+            if not isinstance(parsed_message, dict) or not parsed_message.get('reply_id'):
+                continue
+            with self._lock:
+                self._results.set(parsed_message['reply_id'], parsed_message)
+                waiters = self._waiters.pop(parsed_message['reply_id'], [])
+            if waiters:
+                logger.info("Matching message found.")
+            for future, started_at, _ in waiters:
+                if resolve(future, parsed_message):
+                    reply_wait.observe(time.time() - started_at, result='reply')
+        self._watermark = newest
+
+    def _run(self):
+        logger.info(f"Starting reply dispatcher for chat {self.group_id}")
+        while True:
+            try:
+                oldest = self._expire_waiters()
+                if oldest is None:
+                    logger.info(f"No pending replies, stopping reply dispatcher for chat {self.group_id}")
+                    return
+                self._poll(oldest)
+            except Exception as e:
+                logger.error(f"Unexpected error in reply dispatcher: {e}")
+            time.sleep(self.poll_interval)
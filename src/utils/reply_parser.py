@@ -0,0 +1,107 @@
+# reply_parser.py
+import json
+import html
+import re
+import time
+import logging
+from xml.etree import ElementTree as ET
+from utils.metrics import registry
+
+
+logger = logging.getLogger('ReplyParser')
+
+# Precompiled once; these run for every message the dispatcher sees
+REPLY_ID_PATTERN = re.compile(r'reply_id(?:&quot;|&#34;|["\'])?\s*:\s*(?:&quot;|&#34;|["\'])?([\w-]+)')
+CODE_BLOCK_PATTERN = re.compile(r'<pre><code class="language-json">(.*?)</code></pre>', re.DOTALL)
+CONTROL_CHARS_PATTERN = re.compile(r'[\x00-\x1f]+')
+
+JSON_SHAPE = 'json'
+CODE_BLOCK_SHAPE = 'code'
+XML_SHAPE = 'xml'
+TEXT_SHAPE = 'text'
+
+# outcome: skipped (no matching reply_id), parsed, or failed
+parse_latency = registry.histogram('reply_parse_seconds', 'try_parse_message latency by outcome', ('outcome',))
+
+
+def classify_content(content):
+    """Decide once which shape a message has, so only one parse strategy runs."""
+    if content.lstrip().startswith('{'):
+        # Entity-escaped JSON would only fail json.loads first
+        return TEXT_SHAPE if '&quot;' in content else JSON_SHAPE
+    if '<pre><code class="language-json">' in content:
+        return CODE_BLOCK_SHAPE
+    if '<' in content:
+        return XML_SHAPE
+    return TEXT_SHAPE
+
+
+def loads_braced(text):
+    """json.loads the outermost {...} in text, or None."""
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        logger.warning("Error parsing content as JSON: %s", e)
+        return None
+
+
+def parse_code_block(content):
+    match = CODE_BLOCK_PATTERN.search(content)
+    if not match:
+        return None
+    json_str = CONTROL_CHARS_PATTERN.sub('', html.unescape(match.group(1)))
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError as e:
+        logger.warning("Error parsing message content as JSON after regex extraction: %s", e)
+        return None
+
+
+def parse_xml(content):
+    """Extract JSON from XML-wrapped content (URIObject and friends), nested or with several roots."""
+    start = content.find('<')
+    end = content.rfind('>')
+    try:
+        root = ET.fromstring(f'<root>{content[start:end + 1]}</root>')
+    except ET.ParseError as e:
+        logger.warning("Error parsing message content as XML: %s", e)
+        return None
+    return loads_braced(html.unescape(''.join(root.itertext())))
+
+
+def try_parse_message(content):
+    """Attempts to parse a Skype message's content into JSON.
+
+    Messages without a reply_id are rejected before any JSON or XML parsing happens.
+    """
+    start = time.perf_counter()
+    if not isinstance(content, str):
+        content = str(content)
+
+    match = REPLY_ID_PATTERN.search(content)
+    if match is None:
+        parse_latency.observe(time.perf_counter() - start, outcome='skipped')
+        return None
+
+    result = parse_reply(content)
+    parse_latency.observe(time.perf_counter() - start, outcome='parsed' if result is not None else 'failed')
+    return result
+
+
+def parse_reply(content):
+    """Parse content already known to carry a reply_id, according to its shape."""
+    shape = classify_content(content)
+    if shape == JSON_SHAPE:
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            return loads_braced(html.unescape(content))
+    if shape == CODE_BLOCK_SHAPE:
+        return parse_code_block(content)
+    if shape == XML_SHAPE:
+        return parse_xml(content)
+    return loads_braced(html.unescape(content))
@@ -0,0 +1,305 @@
+# send_scheduler.py
+import threading
+import time
+from collections import deque
+import logging
+from utils.ttl_cache import TTLCache
+
+
+logger = logging.getLogger('SendScheduler')
+
+# group_id comes from clients, so idle groups' buckets are dropped once they have refilled
+# (a fresh bucket is identical) at most this often
+BUCKET_SWEEP_INTERVAL = 60
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst` tokens."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available (0 if one is available now)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now=None):
+        self.wait_time(now)
+        return self.tokens >= self.burst
+
+
+class QueuedMessage:
+    def __init__(self, group_id, message, enqueued_at=None, coalesce=True):
+        self.group_id = group_id
+        self.message = message
+        self.enqueued_at = time.time() if enqueued_at is None else enqueued_at
+        self.coalesce = coalesce
+        self.id = None
+        self.ids = []
+        self.attempts = 1
+        self.count = 1
+        # Set by backends that track claims (SQLiteSendQueue)
+        self.claim = None
+
+
+class CoalescePolicy:
+    """Merges waiting messages for the same group into one Skype post.
+
+    Only consecutive messages queued with coalesce=True are merged, up to
+    max_chars in total. When max_delay is set, a lone message is held until it
+    is that old so later ones can join it, unless the run is already full.
+    """
+
+    def __init__(self, max_chars=4000, max_delay=0.0, separator='\n\n-----\n\n'):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.separator = separator
+
+    def take_run(self, items):
+        """Number of leading items (each with .message and .coalesce) to merge; at least 1."""
+        first = items[0]
+        if not first.coalesce:
+            return 1
+        size = len(first.message)
+        count = 1
+        for item in items[1:]:
+            size += len(self.separator) + len(item.message)
+            if not item.coalesce or size > self.max_chars:
+                break
+            count += 1
+        return count
+
+    def hold_for(self, items, count, now):
+        """Seconds to keep waiting for more messages before sending this run (0 to send now)."""
+        first = items[0]
+        if not first.coalesce or not self.max_delay or count < len(items):
+            return 0.0
+        size = sum(len(item.message) for item in items[:count]) + len(self.separator) * (count - 1)
+        if size >= self.max_chars:
+            return 0.0
+        return max(0.0, first.enqueued_at + self.max_delay - now)
+
+    def merge(self, items):
+        if len(items) == 1:
+            return items[0]
+        merged = QueuedMessage(items[0].group_id, self.separator.join(item.message for item in items),
+                               min(item.enqueued_at for item in items))
+        merged.id = items[0].id
+        merged.ids = [item.id for item in items]
+        merged.attempts = max(item.attempts for item in items)
+        merged.count = len(items)
+        return merged
+
+
+class MemorySendQueue:
+    """In-process send queue keeping one FIFO and one token bucket per group.
+
+    A group is handed to at most one worker at a time, so messages to the same
+    group keep their order while different groups are sent in parallel.
+    """
+
+    # Claims never expire here, so there is nothing to renew while a send is in flight
+    renew_interval = None
+
+    def __init__(self, limits, coalesce=None):
+        self.limits = limits
+        self.coalesce = coalesce
+        self._groups = {}
+        self._buckets = {}
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._swept_at = time.monotonic()
+
+    def _bucket(self, group_id):
+        bucket = self._buckets.get(group_id)
+        if bucket is None:
+            rate, burst = self.limits(group_id)
+            bucket = self._buckets[group_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _sweep_buckets(self, now):
+        self._swept_at = now
+        for group_id in [group_id for group_id, bucket in self._buckets.items()
+                         if group_id not in self._groups and group_id not in self._busy and bucket.is_full(now)]:
+            del self._buckets[group_id]
+
+    def put(self, group_id, message, coalesce=True):
+        with self._cond:
+            self._groups.setdefault(group_id, deque()).append(QueuedMessage(group_id, message, coalesce=coalesce))
+            self._cond.notify()
+
+    def claim(self, timeout=1.0):
+        """Return the next message whose group has a free token, waiting up to timeout seconds."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                next_wait = deadline - now
+                if next_wait <= 0:
+                    return None
+                if now - self._swept_at > BUCKET_SWEEP_INTERVAL:
+                    self._sweep_buckets(now)
+                for group_id, pending in self._groups.items():
+                    if not pending or group_id in self._busy:
+                        continue
+                    count = 1
+                    if self.coalesce:
+                        items = list(pending)
+                        count = self.coalesce.take_run(items)
+                        hold = self.coalesce.hold_for(items, count, time.time())
+                        if hold:
+                            next_wait = min(next_wait, hold)
+                            continue
+                    bucket = self._bucket(group_id)
+                    wait = bucket.wait_time(now)
+                    if wait == 0:
+                        bucket.consume()
+                        self._busy.add(group_id)
+                        items = [pending.popleft() for _ in range(count)]
+                        return self.coalesce.merge(items) if self.coalesce else items[0]
+                    next_wait = min(next_wait, wait)
+                self._cond.wait(next_wait)
+
+    def ack(self, item):
+        with self._cond:
+            self._busy.discard(item.group_id)
+            if not self._groups.get(item.group_id):
+                self._groups.pop(item.group_id, None)
+            self._cond.notify()
+
+    def fail(self, item, error=None):
+        # Nothing survives a restart here anyway, so failed messages are dropped like before
+        self.ack(item)
+
+    def depth(self):
+        with self._cond:
+            return {group_id: len(pending) for group_id, pending in self._groups.items() if pending}
+
+    def oldest(self):
+        """Enqueue time of the oldest waiting message per group."""
+        with self._cond:
+            return {group_id: pending[0].enqueued_at for group_id, pending in self._groups.items() if pending}
+
+
+class SendScheduler:
+    """Pool of sender workers draining a rate limited send queue."""
+
+    def __init__(self, backend, send_func, workers=4, stats_maxsize=1000, stats_ttl=3600):
+        self.backend = backend
+        self.send_func = send_func
+        self.workers = workers
+        self._threads = []
+        # Wait statistics of recently active groups only; the rest age out
+        self._wait_stats = TTLCache(maxsize=stats_maxsize, ttl=stats_ttl)
+        self._stats_lock = threading.Lock()
+        # Items being sent right now, whose claims the renewer keeps alive
+        self._in_flight = {}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"MessageSender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.backend.renew_interval:
+            thread = threading.Thread(target=self._renewer, name="MessageClaimRenewer", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} message sender workers")
+
+    def _renewer(self):
+        """Extends the claims of in-flight sends, so a slow Skype call is not claimed and sent again elsewhere."""
+        while True:
+            time.sleep(self.backend.renew_interval)
+            with self._stats_lock:
+                items = list(self._in_flight.values())
+            for item in items:
+                try:
+                    self.backend.renew(item)
+                except Exception as e:
+                    logger.error(f"Failed to renew claim on queued message: {e}")
+
+    def submit(self, group_id, message, coalesce=True):
+        self.backend.put(group_id, message, coalesce)
+
+    def _record_wait(self, group_id, waited):
+        with self._stats_lock:
+            stats = self._wait_stats.get(group_id) or {"sent": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": 0.0}
+            stats["sent"] += 1
+            stats["total_wait"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+            stats["last_wait"] = waited
+            self._wait_stats.set(group_id, stats)
+
+    def _worker(self):
+        logger.info("Starting message sender thread...")
+        backoff = 0.0
+        while True:
+            try:
+                item = self.backend.claim(timeout=1.0)
+            except Exception as e:
+                # E.g. "database is locked" after the busy timeout; the thread must outlive it
+                backoff = min(max(backoff * 2, 0.5), 30.0)
+                logger.error("Failed to claim from send queue, retrying in %.1fs: %s", backoff, e)
+                time.sleep(backoff)
+                continue
+            backoff = 0.0
+            if item is None:
+                continue
+            self._record_wait(item.group_id, time.time() - item.enqueued_at)
+            with self._stats_lock:
+                self._in_flight[id(item)] = item
+            try:
+                sent = self.send_func(item.group_id, item.message)
+                error = None if sent else "Failed to send message"
+            except Exception as e:
+                logger.error("Unexpected error in message sender: %s", e)
+                sent, error = False, str(e)
+            finally:
+                with self._stats_lock:
+                    self._in_flight.pop(id(item), None)
+            try:
+                if sent:
+                    self.backend.ack(item)
+                    if item.count > 1:
+                        logger.info("Coalesced %d messages into one post", item.count)
+                    logger.info("Message sent successfully")
+                else:
+                    self.backend.fail(item, error)
+            except Exception as e:
+                logger.error(f"Failed to update send queue: {e}")
+
+    def stats(self):
+        """Queue depth and queue wait times (seconds) per group."""
+        now = time.time()
+        depth = self.backend.depth()
+        oldest = self.backend.oldest()
+        with self._stats_lock:
+            wait_stats = dict(self._wait_stats.items())
+            result = {}
+            for group_id in set(depth) | set(wait_stats):
+                stats = wait_stats.get(group_id, {"sent": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": 0.0})
+                result[group_id] = {
+                    "queued": depth.get(group_id, 0),
+                    "oldest_wait": round(now - oldest[group_id], 3) if group_id in oldest else 0.0,
+                    "sent": stats["sent"],
+                    "avg_wait": round(stats["total_wait"] / stats["sent"], 3) if stats["sent"] else 0.0,
+                    "max_wait": round(stats["max_wait"], 3),
+                    "last_wait": round(stats["last_wait"], 3),
+                }
+            return result
@@ -1,22 +1,20 @@
 # skype_messaging.py
-from skpy import Skype, SkypeAuthException, SkypeEventLoop, SkypeNewMessageEvent
 import os
-import time
-from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import logging
 import json
-import html
-import re
-import pytz
-from xml.etree import ElementTree as ET
 import threading
-import queue
+import time
+from utils.reply_dispatcher import ReplyDispatcher
+from utils.reply_parser import try_parse_message
+from utils.send_scheduler import MemorySendQueue, SendScheduler, CoalescePolicy
+from utils.durable_queue import SQLiteSendQueue
+from utils.skype_pool import SkypeSessionPool, load_accounts
+from utils.metrics import registry
 
 
 
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('SkypeMessaging')
 
 load_dotenv()
@@ -24,186 +22,160 @@ load_dotenv()
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
-# Skype credentials and session file path
-SKYPE_USERNAME = os.getenv("SKYPE_USERNAME")
-SKYPE_PASSWORD = os.getenv("SKYPE_PASSWORD")
-SESSION_FILE = 'skype_session.skype'
-
-# Initialize a global Skype object
-global_skype = None
-
-message_queue = queue.Queue()
-
-
-def session_file_is_old_or_missing(file_path):
-    """Check if the session file is older than 24 hours or does not exist."""
-    if not os.path.exists(file_path):
-        logger.info("Session file does not exist.")
-        return True
-    last_modified_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-    if datetime.now() - last_modified_time > timedelta(hours=24):
-        logger.info("Session file is older than 24 hours.")
-        return True
-    return False
-
-def create_new_skype_session():
-    """Create a new Skype session and return the instance."""
-    try:
-        logger.info("Creating new Skype session.")
-        return Skype(os.getenv("SKYPE_USERNAME"), os.getenv("SKYPE_PASSWORD"), SESSION_FILE)
-    except SkypeAuthException as e:
-        logger.error(f"Skype authentication failed: {e}")
-        print(f"Skype authentication failed: {e}")
-        return None
-
-def get_skype_instance():
-    global global_skype
-    if global_skype and global_skype.conn.connected:
-        logger.info("Skype instance is already connected.")
-        return global_skype
-
-    if session_file_is_old_or_missing(SESSION_FILE):
-        global_skype = create_new_skype_session()
-        return global_skype
-
-    try:
-        logger.info("Loading Skype session from file.")
-        global_skype = Skype(tokenFile=SESSION_FILE)  # Use the token file to authenticate
-        return global_skype
-    except SkypeAuthException:
-        logger.error("Failed to load Skype session from file. Attempting new login.")
-        global_skype = create_new_skype_session()
-        return global_skype
-
-def message_sender():
-    logger.info("Starting message sender thread...")
-    while True:
-        logger.info("Checking for messages to send...")
-        group_id, message = message_queue.get()
-        send_skype_message(group_id, message)
-        time.sleep(30)
-        message_queue.task_done()
-        logger.info("Message sent successfully")
-
-def enqueue_message(group_id, message):
-    message_queue.put((group_id, message))
-    
+# Skype accounts (SKYPE_ACCOUNTS, or SKYPE_USERNAME/SKYPE_PASSWORD); each keeps its own session file
+# and chat cache, and groups are spread over them by consistent hashing
+skype_pool = SkypeSessionPool.from_accounts(load_accounts())
+
+# Per-group send rate limits, in messages per minute. SEND_GROUP_LIMITS may override them
+# per group, e.g. {"19:abc@thread.skype": {"rate": 10, "burst": 3}}
+SEND_RATE_LIMIT = float(os.getenv('SEND_RATE_LIMIT', '2'))
+SEND_BURST_LIMIT = int(os.getenv('SEND_BURST_LIMIT', '1'))
+SEND_GROUP_LIMITS = json.loads(os.getenv('SEND_GROUP_LIMITS') or '{}')
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '4'))
+
+# 'sqlite' keeps the queue in db/message_queue.db, shared by all worker processes; 'memory' is per process
+MESSAGE_QUEUE_BACKEND = os.getenv('MESSAGE_QUEUE_BACKEND', 'sqlite').lower()
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('QUEUE_VISIBILITY_TIMEOUT', '60'))
+QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', '5'))
+QUEUE_RETRY_DELAY = float(os.getenv('QUEUE_RETRY_DELAY', '30'))
+
+# Opt-in: queued messages for the same group are merged into one post, up to
+# SEND_COALESCE_MAX_CHARS, waiting at most SEND_COALESCE_MAX_DELAY seconds for company
+SEND_COALESCE = os.getenv('SEND_COALESCE', 'false').lower() == 'true'
+SEND_COALESCE_MAX_CHARS = int(os.getenv('SEND_COALESCE_MAX_CHARS', '4000'))
+SEND_COALESCE_MAX_DELAY = float(os.getenv('SEND_COALESCE_MAX_DELAY', '0'))
+SEND_COALESCE_SEPARATOR = os.getenv('SEND_COALESCE_SEPARATOR', '\n\n-----\n\n').replace('\\n', '\n')
+
+# group_id comes from clients, so only these groups get their own metric label; the rest share 'other'
+METRICS_GROUP_IDS = {group_id.strip() for group_id in [os.getenv('GROUP_ID') or '', *SEND_GROUP_LIMITS,
+                                                        *os.getenv('METRICS_GROUP_IDS', '').split(',')] if group_id.strip()}
+
+def metrics_group(group_id):
+    return group_id if group_id in METRICS_GROUP_IDS else 'other'
+
+enqueue_latency = registry.histogram('skype_enqueue_seconds', 'Time to hand a message to the send queue')
+messages_enqueued = registry.counter('skype_messages_enqueued_total', 'Messages handed to the send queue, by configured group or other', ('group_id',))
+send_latency = registry.histogram('skype_send_seconds', 'Skype send latency by result', ('result',))
+sends = registry.counter('skype_sends_total', 'Skype sends by account and result', ('account', 'result'))
+
+# The dispatcher expires reply futures itself; waiting this much longer only guards against a stuck poller
+REPLY_WAIT_MARGIN = 10
+
+# Created per process by init_messaging(), never at import, so the app can be preloaded and forked
+send_scheduler = None
+messaging_pid = None
+messaging_lock = threading.Lock()
+
+# One reply dispatcher per chat, shared by every request waiting on that chat
+reply_dispatchers = {}
+reply_dispatchers_lock = threading.Lock()
+
+
+def get_skype_instance(group_id=None):
+    return skype_pool.session_for(group_id).get_instance()
+
+def get_send_limits(group_id):
+    """Return (rate per second, burst) for group_id."""
+    limits = SEND_GROUP_LIMITS.get(group_id, {})
+    rate = float(limits.get('rate', SEND_RATE_LIMIT))
+    burst = int(limits.get('burst', SEND_BURST_LIMIT))
+    return rate / 60.0, burst
+
+def create_send_queue():
+    coalesce = None
+    if SEND_COALESCE:
+        logger.info("Coalescing queued messages per group")
+        coalesce = CoalescePolicy(SEND_COALESCE_MAX_CHARS, SEND_COALESCE_MAX_DELAY, SEND_COALESCE_SEPARATOR)
+    if MESSAGE_QUEUE_BACKEND == 'memory':
+        logger.info("Using in-memory message queue")
+        return MemorySendQueue(get_send_limits, coalesce=coalesce)
+    logger.info("Using SQLite message queue")
+    return SQLiteSendQueue(get_send_limits, visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+                           max_attempts=QUEUE_MAX_ATTEMPTS, retry_delay=QUEUE_RETRY_DELAY, coalesce=coalesce)
+
+def enqueue_message(group_id, message, coalesce=True):
+    """Queue a message for sending. Pass coalesce=False for messages that must be posted on their own."""
+    scheduler = init_messaging()
+    with enqueue_latency.time():
+        scheduler.submit(group_id, message, coalesce)
+    messages_enqueued.inc(group_id=metrics_group(group_id))
+
+def get_queue_stats():
+    return init_messaging().stats()
 
 def send_skype_message(group_id, message):
-    skype = get_skype_instance()
-    if skype is None:
-        logger.error("Failed to get Skype instance")
-        print("Failed to get Skype instance")
-        return False
-
+    session = skype_pool.session_for(group_id)
+    start = time.perf_counter()
+    result = 'error'
     try:
-        chat = skype.chats.chat(group_id)
+        chat = session.chat(group_id)
+        if chat is None:
+            skype_pool.report_failure(session)
+            logger.error("Failed to get Skype instance")
+            return False
         chat.sendMsg(message)
+        skype_pool.report_success(session)
+        result = 'ok'
         logger.info("Message sent successfully")
         return True
     except Exception as e:
-        logger.error(f"Error in Skype Messaging: {e}")
-        print(f"Error in Skype Messaging: {e}")
+        # Drop the cached chat in case it is what went stale
+        session.invalidate_chat(group_id)
+        skype_pool.report_failure(session)
+        logger.error("Error in Skype Messaging: %s", e)
         return False
+    finally:
+        send_latency.observe(time.perf_counter() - start, result=result)
+        sends.inc(account=session.account_id, result=result)
     
-def fetch_skype_reply(group_id, unique_id, timeout=120):
-    skype = get_skype_instance()
-    if skype is None:
+def get_reply_dispatcher(group_id):
+    """Return the shared reply dispatcher for group_id, creating it on first use."""
+    with reply_dispatchers_lock:
+        dispatcher = reply_dispatchers.get(group_id)
+        if dispatcher is None:
+            dispatcher = ReplyDispatcher(group_id, lambda: get_skype_chat(group_id), try_parse_message)
+            reply_dispatchers[group_id] = dispatcher
+        return dispatcher
+
+def get_skype_chat(group_id):
+    chat = skype_pool.session_for(group_id).chat(group_id)
+    if chat is None:
         logger.error("Failed to get Skype instance.")
-        return None
-
-    chat = skype.chats.chat(group_id)
-    # Ensure that both times are in the same timezone for accurate comparison
-    start_fetch_time = datetime.now(pytz.utc)  # Assuming your server is using UTC
-
-    while datetime.now(pytz.utc) - start_fetch_time < timedelta(seconds=timeout):
-        # logger.info("Checking for new messages...")
-        messages = chat.getMsgs()  # Fetch the latest batch of messages
-        for message in messages:
-            # logger.info(f"Checking message with time: {message.time}")
-            # Convert message time to UTC for accurate comparison
-            message_time_utc = message.time.replace(tzinfo=pytz.utc)
-            # logger.info(f"Message time in UTC: {message_time_utc}")
-            # logger.info(f"Start fetch time: {start_fetch_time}")
-            if message_time_utc > start_fetch_time:
-                logger.info(f"Checking message with content: {message.content}")
-                parsed_message = try_parse_message(message)
-                logger.info(f"Parsed message: {parsed_message}")
-                if parsed_message and parsed_message.get('reply_id') == unique_id:
-                    logger.info("Matching message found.")
-                    return parsed_message
-        
-        time.sleep(1)  # Check for new messages every second
-
-    logger.info("Timeout reached without finding a matching message.")
-    return None
+    return chat
 
-def clean_xml_content(content):
-    """Cleans XML content by removing or replacing invalid characters."""
-    # Remove characters before the first "<"
-    content = re.sub(r'^[^<]+', '', content)
-    # Remove characters after the last ">"
-    content = re.sub(r'>[^>]+$', '>', content)
-    # Wrap content in a root element if it contains multiple root elements
-    try:
-        ET.fromstring(content)
-    except ET.ParseError:
-        content = f'<root>{content}</root>'
-    return content
+def expect_skype_reply(group_id, unique_id, timeout=120):
+    """Start waiting for the reply to unique_id; call before sending so the reply cannot be missed."""
+    return get_reply_dispatcher(group_id).register(unique_id, timeout)
 
-def extract_json_from_xml(content):
-    """Extracts JSON string from XML content, handling cases where the target text may be nested."""
+def fetch_skype_reply(group_id, unique_id, timeout=120, future=None):
+    """Wait for the reply carrying reply_id == unique_id, without polling the chat per request."""
+    if future is None:
+        future = expect_skype_reply(group_id, unique_id, timeout)
     try:
-        root = ET.fromstring(content)
-        # Check if root.text is None and handle accordingly
-        if root.text is not None:
-            json_str = html.unescape(root.text)
-        else:
-            # If root.text is None, look for JSON within child elements
-            # This is a simplified example; you may need to adjust based on your XML structure
-            json_str = ''
-            for child in root:
-                if child.text:
-                    json_str += html.unescape(child.text)
-                # Optionally, handle nested structures or attributes if your data requires it
-        return json_str
-    except ET.ParseError as e:
-        logger.error(f"Error parsing message content as XML: {e}")
-        return None
-
-def try_parse_message(content):
-    """Attempts to parse a Skype message's content into JSON."""
-    # Convert content to string if it's not already
-    if not isinstance(content, str):
-        content = str(content)
-
-    content = clean_xml_content(content)
-
-    # Attempt to directly parse the content as JSON
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        pass  # Continue to try other methods if direct JSON parsing fails
-
-    # Attempt to extract JSON from XML content
-    json_str = extract_json_from_xml(content)
-    if json_str:
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing content as JSON: {e}")
-    
-    # Attempt to extract and parse JSON using regex
-    json_str_match = re.search(r'<pre><code class="language-json">(.*?)</code></pre>', content, re.DOTALL)
-    if json_str_match:
-        json_str = html.unescape(json_str_match.group(1))
-        # Remove invalid control characters
-        json_str = re.sub(r'[\x00-\x1f]+', '', json_str)
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing message content as JSON after regex extraction: {e}")
+        return future.result(timeout=timeout + REPLY_WAIT_MARGIN)
+    except TimeoutError:
+        return give_up_on_reply(group_id, unique_id, future)
 
+def give_up_on_reply(group_id, unique_id, future):
+    """Stop waiting for a reply the dispatcher never delivered; returns None like a timed out wait."""
+    get_reply_dispatcher(group_id).cancel(unique_id, future)
+    logger.info("Timeout reached without finding a matching message.")
     return None
 
-threading.Thread(target=message_sender, daemon=True).start()
+def init_messaging():
+    """Start this process's sender workers and Skype session refreshers, and return the scheduler.
+
+    Cheap to call repeatedly. In a process forked after initialization, the
+    inherited threads are gone, so fresh ones are started.
+    """
+    global send_scheduler, messaging_pid
+    if messaging_pid == os.getpid():
+        return send_scheduler
+    with messaging_lock:
+        if messaging_pid != os.getpid():
+            scheduler = SendScheduler(create_send_queue(), send_skype_message, workers=SEND_WORKERS)
+            scheduler.start()
+            skype_pool.start_refreshers()
+            send_scheduler = scheduler
+            messaging_pid = os.getpid()
+    return send_scheduler
@@ -0,0 +1,132 @@
+# skype_pool.py
+import bisect
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import logging
+from utils.skype_session import SkypeSession
+
+
+logger = logging.getLogger('SkypePool')
+
+# Consecutive send failures after which an account is taken out of rotation, and for how long
+SKYPE_ACCOUNT_FAILURE_THRESHOLD = int(os.getenv('SKYPE_ACCOUNT_FAILURE_THRESHOLD', '3'))
+SKYPE_ACCOUNT_COOLDOWN = float(os.getenv('SKYPE_ACCOUNT_COOLDOWN', '300'))
+SKYPE_SESSION_DIR = os.getenv('SKYPE_SESSION_DIR', '.')
+# The single-account setup keeps the file name earlier releases used, so upgrades reuse its token
+LEGACY_SESSION_FILE = 'skype_session.skype'
+
+
+def session_file_for(username, session_dir=SKYPE_SESSION_DIR):
+    safe_name = re.sub(r'[^\w.-]', '_', username or 'default')
+    return os.path.join(session_dir, f'skype_session_{safe_name}.skype')
+
+
+def load_accounts():
+    """Accounts from SKYPE_ACCOUNTS (a JSON list of {"username", "password"}), else SKYPE_USERNAME/SKYPE_PASSWORD."""
+    accounts = json.loads(os.getenv('SKYPE_ACCOUNTS') or '[]')
+    if not accounts:
+        accounts = [{"username": os.getenv("SKYPE_USERNAME"), "password": os.getenv("SKYPE_PASSWORD"),
+                     "session_file": os.path.join(SKYPE_SESSION_DIR, LEGACY_SESSION_FILE)}]
+    return accounts
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class AccountHealth:
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+
+class SkypeSessionPool:
+    """A set of Skype accounts; each group is pinned to one of them by consistent hashing.
+
+    Adding an account only moves the groups that land on its share of the
+    ring. An account failing SKYPE_ACCOUNT_FAILURE_THRESHOLD sends in a row is
+    skipped for SKYPE_ACCOUNT_COOLDOWN seconds and its groups move to the next
+    account on the ring, which must also be a member of those groups.
+    """
+
+    def __init__(self, sessions, replicas=100, failure_threshold=SKYPE_ACCOUNT_FAILURE_THRESHOLD, cooldown=SKYPE_ACCOUNT_COOLDOWN):
+        if not sessions:
+            raise ValueError("A Skype session pool needs at least one session")
+        self.sessions = sessions
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health = {id(session): AccountHealth() for session in sessions}
+        self._lock = threading.Lock()
+        self._ring = sorted((ring_hash(f"{session.username}#{replica}"), index)
+                            for index, session in enumerate(sessions) for replica in range(replicas))
+        self._ring_keys = [key for key, _ in self._ring]
+
+    @classmethod
+    def from_accounts(cls, accounts, skype_factory=None, **kwargs):
+        session_kwargs = {"skype_factory": skype_factory} if skype_factory else {}
+        sessions = [SkypeSession(account["username"], account["password"],
+                                 account.get("session_file") or session_file_for(account["username"]), **session_kwargs)
+                    for account in accounts]
+        return cls(sessions, **kwargs)
+
+    def is_healthy(self, session, now=None):
+        now = time.monotonic() if now is None else now
+        return self.health[id(session)].unhealthy_until <= now
+
+    def session_for(self, group_id=None):
+        """The session owning group_id, skipping accounts in cooldown (falls back to the owner if all are)."""
+        if group_id is None or len(self.sessions) == 1:
+            return self.sessions[0]
+        now = time.monotonic()
+        start = bisect.bisect(self._ring_keys, ring_hash(group_id)) % len(self._ring)
+        owner = None
+        tried = set()
+        for offset in range(len(self._ring)):
+            index = self._ring[(start + offset) % len(self._ring)][1]
+            if index in tried:
+                continue
+            tried.add(index)
+            session = self.sessions[index]
+            owner = owner or session
+            if self.is_healthy(session, now):
+                return session
+            if len(tried) == len(self.sessions):
+                break
+        return owner
+
+    def report_success(self, session):
+        with self._lock:
+            health = self.health[id(session)]
+            health.sent += 1
+            health.consecutive_failures = 0
+
+    def report_failure(self, session):
+        with self._lock:
+            health = self.health[id(session)]
+            health.errors += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= self.failure_threshold:
+                health.unhealthy_until = time.monotonic() + self.cooldown
+                health.consecutive_failures = 0
+                logger.error(f"Skype account {session.username} failed {self.failure_threshold} sends in a row, "
+                             f"taking it out of rotation for {self.cooldown} seconds")
+
+    def start_refreshers(self):
+        for session in self.sessions:
+            session.start_refresher()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "account": session.account_id,
+                "healthy": self.health[id(session)].unhealthy_until <= now,
+                "sent": self.health[id(session)].sent,
+                "errors": self.health[id(session)].errors,
+            } for session in self.sessions]
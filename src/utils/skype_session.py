@@ -0,0 +1,137 @@
+# skype_session.py
+from skpy import Skype, SkypeAuthException
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import logging
+import hashlib
+from utils.ttl_cache import TTLCache
+
+
+logger = logging.getLogger('SkypeSession')
+
+SESSION_MAX_AGE = timedelta(hours=24)
+# Renew the session this many seconds before it would be considered old, off the request path
+SKYPE_SESSION_REFRESH_MARGIN = float(os.getenv('SKYPE_SESSION_REFRESH_MARGIN', '3600'))
+SKYPE_SESSION_CHECK_INTERVAL = float(os.getenv('SKYPE_SESSION_CHECK_INTERVAL', '300'))
+SKYPE_CHAT_CACHE_SIZE = int(os.getenv('SKYPE_CHAT_CACHE_SIZE', '256'))
+SKYPE_CHAT_CACHE_TTL = float(os.getenv('SKYPE_CHAT_CACHE_TTL', '3600'))
+
+
+def session_file_age(file_path):
+    """Age of the session file as a timedelta, or None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    return datetime.now() - datetime.fromtimestamp(os.path.getmtime(file_path))
+
+def session_file_is_old_or_missing(file_path):
+    """Check if the session file is older than 24 hours or does not exist."""
+    age = session_file_age(file_path)
+    if age is None:
+        logger.info("Session file does not exist.")
+        return True
+    if age > SESSION_MAX_AGE:
+        logger.info("Session file is older than 24 hours.")
+        return True
+    return False
+
+
+class SkypeSession:
+    """One Skype login: the connected instance, its token file and a cache of chat objects.
+
+    All access to the instance goes through a lock, so request threads, sender
+    workers and the refresher never race to log in. A background refresher
+    renews the session before the token file is old enough to force a login
+    on the request path.
+    """
+
+    def __init__(self, username, password, session_file, chat_cache_size=SKYPE_CHAT_CACHE_SIZE, chat_cache_ttl=SKYPE_CHAT_CACHE_TTL,
+                 skype_factory=Skype):
+        self.username = username
+        # Stands in for the username wherever it would be published (/health, /metrics)
+        self.account_id = hashlib.sha256((username or '').encode('utf-8')).hexdigest()[:12]
+        self.password = password
+        self.session_file = session_file
+        self.skype_factory = skype_factory
+        self.chats = TTLCache(maxsize=chat_cache_size, ttl=chat_cache_ttl)
+        self._skype = None
+        self._lock = threading.RLock()
+        self._refresher = None
+
+    def _login(self):
+        """Create a new Skype session and return the instance."""
+        try:
+            logger.info("Creating new Skype session.")
+            return self.skype_factory(self.username, self.password, self.session_file)
+        except SkypeAuthException as e:
+            logger.error(f"Skype authentication failed: {e}")
+            return None
+
+    def _connect(self):
+        if session_file_is_old_or_missing(self.session_file):
+            return self._login()
+        try:
+            logger.info("Loading Skype session from file.")
+            return self.skype_factory(tokenFile=self.session_file)  # Use the token file to authenticate
+        except SkypeAuthException:
+            logger.error("Failed to load Skype session from file. Attempting new login.")
+            return self._login()
+
+    def _replace(self, skype):
+        self._skype = skype
+        # Chat objects hold a reference to the connection that created them
+        self.chats.clear()
+
+    def get_instance(self):
+        skype = self._skype
+        if skype is not None and skype.conn.connected:
+            return skype
+        with self._lock:
+            if self._skype is None or not self._skype.conn.connected:
+                self._replace(self._connect())
+            return self._skype
+
+    def chat(self, group_id):
+        chat = self.chats.get(group_id)
+        if chat is not None:
+            return chat
+        skype = self.get_instance()
+        if skype is None:
+            return None
+        chat = skype.chats.chat(group_id)
+        self.chats.set(group_id, chat)
+        return chat
+
+    def invalidate_chat(self, group_id):
+        self.chats.invalidate(group_id)
+
+    def refresh(self):
+        """Log in again and swap the new instance in; the old one keeps serving until then."""
+        skype = self._login()
+        if skype is None:
+            return False
+        with self._lock:
+            self._replace(skype)
+        logger.info("Skype session refreshed.")
+        return True
+
+    def needs_refresh(self):
+        age = session_file_age(self.session_file)
+        return age is None or age > SESSION_MAX_AGE - timedelta(seconds=SKYPE_SESSION_REFRESH_MARGIN)
+
+    def _refresh_loop(self, interval):
+        while True:
+            try:
+                if self.needs_refresh():
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Skype session refresh failed: {e}")
+            time.sleep(interval)
+
+    def start_refresher(self, interval=SKYPE_SESSION_CHECK_INTERVAL):
+        with self._lock:
+            # A thread inherited across fork() is no longer alive
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,), name='SkypeSessionRefresher', daemon=True)
+                self._refresher.start()
@@ -0,0 +1,73 @@
+# storage.py
+import os
+import sqlite3
+import threading
+import logging
+
+
+logger = logging.getLogger('Storage')
+
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '30'))
+
+# Directory holding every SQLite database file
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SQLITE_DB_DIR = os.getenv('SQLITE_DB_DIR', os.path.join(BASE_DIR, 'db'))
+
+# path -> {thread ident: connection}; each thread keeps one persistent connection per database file.
+# Connections must not cross fork(), so a child process starts with an empty registry.
+_sqlite_connections = {}
+_sqlite_lock = threading.Lock()
+_sqlite_pid = os.getpid()
+# Connections inherited from the parent, kept referenced so they are never closed (or finalized) here
+_inherited_sqlite_connections = []
+
+
+def _close_dead_thread_connections(connections):
+    alive = {thread.ident for thread in threading.enumerate()}
+    for ident in [ident for ident in connections if ident not in alive]:
+        try:
+            connections.pop(ident).close()
+        except Exception as e:
+            logger.error(f"Failed to close SQLite connection: {e}")
+
+
+def get_sqlite_connection(path):
+    """Return this thread's persistent connection to path, in WAL mode and autocommit.
+
+    Callers needing a multi-statement transaction issue BEGIN/COMMIT themselves.
+    """
+    global _sqlite_pid
+    ident = threading.get_ident()
+    with _sqlite_lock:
+        if _sqlite_pid != os.getpid():
+            _inherited_sqlite_connections.append(dict(_sqlite_connections))
+            _sqlite_connections.clear()
+            _sqlite_pid = os.getpid()
+        connections = _sqlite_connections.setdefault(path, {})
+        conn = connections.get(ident)
+        if conn is not None:
+            return conn
+        _close_dead_thread_connections(connections)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with _sqlite_lock:
+        _sqlite_connections[path][ident] = conn
+    return conn
+
+
+def add_column_if_missing(conn, table, column, definition):
+    """Schema migration for databases created by an older release."""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info(f"Added column {column} to {table}")
+
+
+def sqlite_pool_stats():
+    """Open connections per database file."""
+    with _sqlite_lock:
+        for connections in _sqlite_connections.values():
+            _close_dead_thread_connections(connections)
+        return {os.path.basename(path): {"connections": len(connections)} for path, connections in _sqlite_connections.items()}